@@ -15,8 +15,10 @@
 #
 # data structure for settings:
 # [
-#    {"path":  STRING,
-#     "files": STRING_ARRAY[3],
+#    {"job":   STRING,                 # id of the job in the journal
+#     "mode":  INT,                    # mode of the last unfinished run or None
+#     "path":  STRING,
+#     "files": STRING_ARRAY[N],
 #     "settings": {
 #                    "blur":        INT,
 #                    "dark_mask":   INT,
@@ -25,7 +27,8 @@
 #                    "scale":       STRING,
 #                    "dark":        INT,
 #                    "trim":        INT,
-#                    "align":       INT
+#                    "align":       INT,
+#                    "keep_tiff":   INT
 #                 }
 #    },
 #    {
@@ -33,6 +36,11 @@
 #    }
 # ]
 #
+# The job list is journaled to JOURNAL_FILE, after a crash the unfinished jobs are
+# loaded again on startup and can be resumed with the "Resume" button or headless with
+#
+#    collect_exposures.py --resume
+#
 #########################################################################################
 
 
@@ -49,10 +57,88 @@ CMD__MOGRIFY="mogrify"
 CMD__JHEAD="jhead"
 CMD__ENFUSE="enfuse"
 
+#########################################################################################
+# python modules
+# --------------
+# the native engines (exposure_engine.py) need NumPy, RAW files need rawpy (LibRaw).
+# Both are optional, without NumPy the external programs above are used. The passport
+# scripts detect faces with OpenCV (cv2) if it is installed.
+# Install them for the python gimp runs, e.g. pip install numpy rawpy opencv-python
+#########################################################################################
+
+# maximum number of concurrent per-file conversions (mogrify / jhead) after alignment,
+# 0 means one per CPU core
+MAX_CONVERT_WORKERS=0
+
+# convert aligned TIFFs to JPG and copy EXIF data in-process with PIL instead of
+# spawning mogrify and jhead for every file
+USE_PIL_CONVERTER=1
+
+# use the built-in NumPy exposure fusion (exposure_engine.py) instead of the external
+# enfuse program, the image is fused in strips of FUSION_TILE_ROWS rows by
+# MAX_FUSION_WORKERS threads (0 means one per CPU core)
+USE_NATIVE_FUSION=1
+FUSION_TILE_ROWS=512
+MAX_FUSION_WORKERS=0
+
+# stacks with more than this number of frames (and all focus stacks) are fused
+# incrementally by the native engine, one frame at a time, so that the memory use
+# does not grow with the number of frames
+INCREMENTAL_FUSION_FRAMES=4
+
+# blend luminosity masks with the built-in NumPy blender instead of gimp's
+# script_fu_exposure_blend, blends run in a pool of MAX_BLEND_WORKERS processes
+# (0 means one per CPU core). Outside of gimp the native blender is always used.
+USE_NATIVE_LUMINOSITY_MASKS=1
+MAX_BLEND_WORKERS=0
+
+# align exposures with the built-in aligner of exposure_engine.py instead of
+# align_image_stack. When the native engines blend as well, the frames are aligned in
+# memory and no aligned files are written.
+USE_NATIVE_ALIGNMENT=1
+
+# with the native aligner and blender, write the aligned frames once as memory-mapped
+# planar files (*.planes, see exposure_engine.py) instead of aligning in memory in
+# every job. Sorting and blending read them without decoding and concurrent jobs on
+# the same stack share them in the page cache. They are written to PLANES_CACHE_DIR
+# (not next to the originals), the oldest ones which no running job uses are removed
+# when the directory grows beyond PLANES_CACHE_SIZE_MB. Aligned files of the "Align"
+# button are used instead if there are any.
+USE_PLANAR_INTERMEDIATES=1
+PLANES_CACHE_DIR="~/.cache/collect_exposures/planes"
+PLANES_CACHE_SIZE_MB=4096
+
+# every job gets its own scratch directory for intermediate files below SCRATCH_DIR,
+# e.g. "/dev/shm" for a tmpfs. Empty means the system's temporary directory.
+SCRATCH_DIR=""
+
+# every finished stage of a job (ingest, sort, align, convert, blend, save) is appended
+# as JSON line with timings, bytes read/written and runtimes of external tools to this
+# file, e.g. "~/collect_exposures.jsonl". Empty disables the log.
+TELEMETRY_LOG=""
+
+# append-only journal of the job list for crash recovery, empty disables it
+JOURNAL_FILE="~/.collect_exposures.journal"
+
+# the stages of the jobs form a pipeline: while one stack is blended the next ones are
+# already aligned and decoded. MAX_IO_STAGES limits the number of jobs in I/O bound
+# stages (ingest, convert, sort, decode, save), MAX_CPU_STAGES the number of jobs in CPU
+# bound stages (align, blend and decoding with alignment in memory), 0 means one per
+# CPU core. The process pool and the memory scheduler limit the blending as well.
+MAX_IO_STAGES=2
+MAX_CPU_STAGES=0
+
+# memory management: jobs are only started when their estimated memory use fits into
+# MEMORY_FRACTION of the free RAM (see ResourceScheduler), MEMORY_PER_PIXEL is the
+# estimated number of bytes a job needs per pixel and frame. The enfuse cache size (-m)
+# and the strip height of the native engine are derived from the memory granted to a
+# job. The free RAM is read again whenever a job is admitted.
+MEMORY_FRACTION=0.75
+MEMORY_PER_PIXEL=48
+MIN_JOB_MEMORY_MB=256
+
 PARAM__ENFUSE_DEFAULT= [
     "--compression=100",            # for JPG output don't use compression
-    "-m 4096",                      # amount of cache in MB
-    "-b 4096",                      # amount of buffer in MB
     "--depth=float",                # image depth for processing
     "--save-masks=%f-softmask.png", # save masks...
 ]
@@ -71,6 +157,27 @@ PARAM__ENFUSE_EXPOSURE_SERIES= [
 
 ALLOWED_FILE_FORMATS=["JPG", "JPEG", "TIFF", "PNG"]
 
+# RAW files (exposure_engine.RAW_FORMATS) are allowed as well when rawpy is installed.
+# They are decoded once to 16-bit linear RGB and cached in RAW_CACHE_DIR, stacks with
+# RAW files always use the native engines. The least recently used decoded files are
+# removed when the cache grows beyond RAW_CACHE_SIZE_MB.
+RAW_CACHE_DIR="~/.cache/collect_exposures/raw"
+RAW_CACHE_SIZE_MB=8192
+
+# fallback for the free RAM in MB if it can't be determined
+DEFAULT_FREE_MEMORY_MB=4096
+
+# cache for aligned intermediates and blended results, keyed on the contents of the
+# input files, the blending mode and the settings. Least recently used entries are
+# removed when the cache grows beyond CACHE_SIZE_MB.
+USE_RESULT_CACHE=1
+CACHE_DIR="~/.cache/collect_exposures"
+CACHE_SIZE_MB=4096
+
+# the aligned files of every stack are recorded in this file in the stack directory,
+# later jobs on the same stack reuse them until the source files change
+ALIGNMENT_MANIFEST=".aligned.json"
+
 
 #########################################################################################
 # Program start
@@ -80,9 +187,25 @@ from PIL import Image
 import ImageStat
 import threading 
 import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import sys, os, subprocess, math
+import hashlib, json, shutil, tempfile, time, contextlib, uuid
 import wx
 
+# the native engines need numpy, fall back to the external programs without it
+try:
+    import exposure_engine
+except ImportError as error:
+    print "Native exposure engine not available (%s), using external programs" % error
+    exposure_engine = None
+
+if exposure_engine:
+    exposure_engine.RAW_CACHE_DIR = os.path.expanduser(RAW_CACHE_DIR)
+    exposure_engine.RAW_CACHE_SIZE_MB = RAW_CACHE_SIZE_MB
+    if exposure_engine.rawpy:
+        ALLOWED_FILE_FORMATS += exposure_engine.RAW_FORMATS
+
 # we just assume the script is started in the context
 # of a gimp-plugin and check whether it's true!
 startedAsGimpPlugin = 1
@@ -105,6 +228,19 @@ print "startedAsGimpPlugin = %d" % startedAsGimpPlugin
 MODE__LUMINOSITY_MASKS = 1
 MODE__ENFUSE = 2
 MODE__ALIGN = 3 # just align images and save aligned files
+MODE__FOCUS_STACK = 4 # enfuse with PARAM__ENFUSE_FOCUS_STACKING
+
+# suffix of the result files of the blending modes
+OUTPUT_SUFFIX = {MODE__LUMINOSITY_MASKS: "_blend",
+                 MODE__ENFUSE:           "_enfuse",
+                 MODE__FOCUS_STACK:      "_focus"}
+
+# settings which change the result of a blending mode, the result cache is keyed on them
+RESULT_SETTINGS = {MODE__LUMINOSITY_MASKS: ["align", "keep_tiff", "blur", "dark_mask",
+                                            "bright_mask", "blur_radius", "scale", "dark",
+                                            "trim"],
+                   MODE__ENFUSE:           ["align", "keep_tiff"],
+                   MODE__FOCUS_STACK:      ["align", "keep_tiff"]}
 
 # Button IDs
 ID_NEW     = 1
@@ -114,6 +250,8 @@ ID_CONFIG  = 4
 ID_PROCESS = 5
 ID_ENFUSE  = 6
 ID_ALIGN   = 7
+ID_RESUME  = 8
+ID_FOCUS   = 9
 
 # Default settings for blending
 DEFAULT_SETTINGS = {"blur":0,
@@ -123,19 +261,22 @@ DEFAULT_SETTINGS = {"blur":0,
                     "scale":"",
                     "dark":0,
                     "trim":0,
-                    "align":0}
+                    "align":0,
+                    "keep_tiff":0}
 
 # Standard directory which pops up when adding exposure stacks to the list   
 CURRENT_DIR="/home/phil"
 
 myEVT_JOB_DONE = wx.NewEventType()
 EVT_JOB_DONE   = wx.PyEventBinder(myEVT_JOB_DONE, 1)
+myEVT_JOB_PROGRESS = wx.NewEventType()
+EVT_JOB_PROGRESS   = wx.PyEventBinder(myEVT_JOB_PROGRESS, 1)
 
 
 
 class ConfigureDialog(wx.Dialog):
     def __init__(self, parent, title, item):
-        super(ConfigureDialog, self).__init__(parent=parent, title=title, size=(450, 280))
+        super(ConfigureDialog, self).__init__(parent=parent, title=title, size=(450, 310))
         self.parent = parent
         self.item = item
         self.settings = parent.list_items[item]["settings"]
@@ -163,11 +304,13 @@ class ConfigureDialog(wx.Dialog):
         self.auto_trim_mask_hist = wx.CheckBox(self, -1, "", style=wx.ALIGN_RIGHT)
         self.label_14 = wx.StaticText(self, -1, "Align Layers")
         self.align_layers = wx.CheckBox(self, -1, "", style=wx.ALIGN_RIGHT)
+        self.label_15 = wx.StaticText(self, -1, "Keep Aligned TIFFs")
+        self.keep_tiff = wx.CheckBox(self, -1, "", style=wx.ALIGN_RIGHT)
         self.defaultsButton = wx.Button(self, -1, "Defaults")
         self.okButton = wx.Button(self, -1, "Ok")
 
         sizer_1 = wx.BoxSizer(wx.VERTICAL)
-        grid_sizer_1 = wx.FlexGridSizer(6, 2, 3, 12)
+        grid_sizer_1 = wx.FlexGridSizer(7, 2, 3, 12)
         grid_sizer_1.Add(self.label_7, 0, 0, 0)
         grid_sizer_1.Add(self.blur, 0, 0, 0)
         grid_sizer_1.Add(self.label_8, 0, 0, 0)
@@ -184,6 +327,8 @@ class ConfigureDialog(wx.Dialog):
         grid_sizer_1.Add(self.auto_trim_mask_hist, 0, 0, 0)
         grid_sizer_1.Add(self.label_14, 0, 0, 0)
         grid_sizer_1.Add(self.align_layers, 0, 0, 0)
+        grid_sizer_1.Add(self.label_15, 0, 0, 0)
+        grid_sizer_1.Add(self.keep_tiff, 0, 0, 0)
         grid_sizer_1.Add(self.defaultsButton, 0, wx.EXPAND, 0)
         grid_sizer_1.Add(self.okButton, 0, wx.EXPAND, 0)
         sizer_1.Add(grid_sizer_1, 1, wx.ALL|wx.EXPAND|wx.ALIGN_CENTER_HORIZONTAL, 5)
@@ -207,19 +352,34 @@ class ConfigureDialog(wx.Dialog):
         self.dark_takes_precedence.SetValue(settings["dark"])
         self.auto_trim_mask_hist.SetValue(settings["trim"])
         self.align_layers.SetValue(settings["align"])
+        self.keep_tiff.SetValue(settings["keep_tiff"])
 
     def OnClose(self, e):
+        # the scale is free text, it has to be empty or a number of pixels
+        scale = self.scale.GetValue().strip()
+        if scale:
+            try:
+                valid = float(scale) >= 1
+            except ValueError:
+                valid = False
+            if not valid:
+                wx.MessageBox("Please enter the number of pixels to scale the largest image "
+                              "dimension to or leave it empty!", "Info", wx.OK | wx.ICON_ERROR)
+                return
         # save settings...
         settings={}
         settings["blur"]=self.blur.GetSelection()
         settings["dark_mask"]=self.dark_mask.GetSelection()
         settings["bright_mask"]=self.bright_mask.GetSelection()
         settings["blur_radius"]=self.blur_radius.GetValue()
-        settings["scale"]=self.scale.GetValue()
+        settings["scale"]=scale
         settings["dark"]=self.dark_takes_precedence.GetValue()
         settings["trim"]=self.auto_trim_mask_hist.GetValue()
         settings["align"]=self.align_layers.GetValue()
+        settings["keep_tiff"]=self.keep_tiff.GetValue()
         self.parent.list_items[self.item]["settings"]=settings
+        if journal:
+            journal.update(self.parent.list_items[self.item]["job"], settings)
         self.Destroy()
 
 
@@ -271,15 +431,21 @@ class MainWindow(wx.Frame):
         self.list_items       = []
         self.list_item_count  = 0
         self.currentDirectory = CURRENT_DIR
-        self.batch  = ""
+        self.batches = {}                   # running blend threads by job id
         self.active_jobs = [] 
         wx.Frame.__init__(self, parent, id, title, size=(750, 300))
 
         panel = wx.Panel(self, -1)
         hbox = wx.BoxSizer(wx.HORIZONTAL)
 
+        listPanel = wx.BoxSizer(wx.VERTICAL)
         self.listbox = wx.ListBox(panel, -1)
-        hbox.Add(self.listbox, 1, wx.EXPAND | wx.ALL, 20)
+        self.progress = wx.Gauge(panel, -1, 100)
+        self.status = wx.StaticText(panel, -1, "")
+        listPanel.Add(self.listbox, 1, wx.EXPAND)
+        listPanel.Add(self.progress, 0, wx.EXPAND | wx.TOP, 5)
+        listPanel.Add(self.status, 0, wx.EXPAND | wx.TOP, 5)
+        hbox.Add(listPanel, 1, wx.EXPAND | wx.ALL, 20)
 
         btnPanel = wx.Panel(panel, -1)
         vbox     = wx.BoxSizer(wx.VERTICAL)
@@ -290,6 +456,8 @@ class MainWindow(wx.Frame):
         self.align   = wx.Button(btnPanel, ID_ALIGN,	'Align',     size=(90, 30))
         self.process = wx.Button(btnPanel, ID_PROCESS,	'Process',   size=(90, 30))
         self.enfuse  = wx.Button(btnPanel, ID_ENFUSE,	'Enfuse',    size=(90, 30))
+        self.focus   = wx.Button(btnPanel, ID_FOCUS,	'Focus',     size=(90, 30))
+        self.resume  = wx.Button(btnPanel, ID_RESUME,	'Resume',    size=(90, 30))
         
         self.Bind(wx.EVT_BUTTON, self.AddFiles, id=ID_NEW)
         self.Bind(wx.EVT_BUTTON, self.OnConfigure, id=ID_CONFIG)
@@ -297,11 +465,14 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_BUTTON, self.OnClear, id=ID_CLEAR)
         self.Bind(wx.EVT_BUTTON, self.OnProcess, id=ID_PROCESS)
         self.Bind(wx.EVT_BUTTON, self.OnEnfuse, id=ID_ENFUSE)
+        self.Bind(wx.EVT_BUTTON, self.OnFocus,  id=ID_FOCUS)
         self.Bind(wx.EVT_BUTTON, self.OnAlign,  id=ID_ALIGN)
+        self.Bind(wx.EVT_BUTTON, self.OnResume, id=ID_RESUME)
         
         self.Bind(wx.EVT_LISTBOX_DCLICK, self.OnConfigure)
         self.Bind(wx.EVT_LISTBOX, self.OnSelect)
         self.Bind(EVT_JOB_DONE, self.OnJobDone)
+        self.Bind(EVT_JOB_PROGRESS, self.OnJobProgress)
         
         vbox.Add((-1, 20))
         vbox.Add(self.new)
@@ -312,6 +483,8 @@ class MainWindow(wx.Frame):
         vbox.Add(self.align,   0, wx.TOP, 5)
         vbox.Add(self.process, 0, wx.TOP, 5)
         vbox.Add(self.enfuse,  0, wx.TOP, 5)
+        vbox.Add(self.focus,   0, wx.TOP, 5)
+        vbox.Add(self.resume,  0, wx.TOP, 5)
         
         btnPanel.SetSizer(vbox)
         hbox.Add(btnPanel, 0.6, wx.EXPAND | wx.RIGHT, 20)
@@ -323,12 +496,21 @@ class MainWindow(wx.Frame):
         self.align.Disable()
         self.process.Disable()
         self.enfuse.Disable()
+        self.focus.Disable()
+        self.resume.Disable()
         
         dt = FileDrop(self)
         self.listbox.SetDropTarget(dt)
         self.Centre()
         self.Show(True)
 
+        if journal:
+            # jobs which were not finished before the last shutdown or crash
+            jobs = journal.load()
+            for job in jobs:
+                self.AppendItem(job)
+            journal.compact(jobs)
+
     def OnSelect(self, event):
         sel = event.GetSelection()
         if sel < 0:
@@ -343,10 +525,12 @@ class MainWindow(wx.Frame):
                 self.align.Enable()
                 self.process.Enable()
                 self.enfuse.Enable()
+                self.focus.Enable()
             else:
                 self.align.Disable()
                 self.process.Disable()
                 self.enfuse.Disable()
+                self.focus.Disable()
             
     def AddFiles(self, event):
         my_wildcard="JPG Files (*.jpg; *.JPG)|*.jpg;*.JPG| TIF Files (*.tif; *.TIF)|*.tif;*.TIF\
@@ -371,15 +555,23 @@ class MainWindow(wx.Frame):
         if count < 2:
             wx.MessageBox("Please select at least 2 pictures!", "Info", wx.OK | wx.ICON_ERROR)
         else:
-            text = '  |  '.join(files)
-            if text != '':
-                self.active_jobs.append(0)
-                self.listbox.Append(text)
-                self.clr.Enable()
-                self.list_items.append({"path": root+"/", "files": files, "settings": DEFAULT_SETTINGS})
-                self.list_item_count += 1
-                print self.list_items
-                print self.list_item_count
+            item = {"job": uuid.uuid4().hex, "mode": None, "path": root+"/", "files": files,
+                    "settings": DEFAULT_SETTINGS}
+            if journal:
+                journal.add(item)
+            self.AppendItem(item)
+            print self.list_items
+            print self.list_item_count
+
+    def AppendItem(self, item):
+        text = '  |  '.join(item["files"])
+        self.active_jobs.append(0)
+        self.listbox.Append(text)
+        self.clr.Enable()
+        self.list_items.append(item)
+        self.list_item_count += 1
+        if item["mode"] is not None:
+            self.resume.Enable()
 
     def OnConfigure(self, event):
         sel = self.listbox.GetSelection()
@@ -393,8 +585,10 @@ class MainWindow(wx.Frame):
         text = self.listbox.GetString(sel)
         if sel != -1:
             self.listbox.Delete(sel)
-            self.list_items.pop(sel)
-            self.active_jobs.remove(sel)
+            item = self.list_items.pop(sel)
+            self.active_jobs.pop(sel)
+            if journal:
+                journal.delete(item["job"])
             self.list_item_count -= 1
         if self.list_item_count == 0:
             self.clr.Disable()
@@ -405,33 +599,51 @@ class MainWindow(wx.Frame):
         self.align.Disable()
         self.process.Disable()
         self.enfuse.Disable()
+        self.focus.Disable()
+        self.resume.Disable()
+        if journal:
+            for item in self.list_items:
+                journal.delete(item["job"])
         del self.list_items[:]
         self.list_item_count = 0
         self.active_jobs = []
          
+    def StartJob(self, sel, mode):
+        self.active_jobs[sel] = 1;
+        self.list_items[sel]["mode"] = mode
+        job = self.list_items[sel]["job"]
+        self.batches[job] = blend(self, sel, mode,
+                                  self.list_items[sel]["path"],
+                                  self.list_items[sel]["files"],
+                                  self.list_items[sel]["settings"],
+                                  job)
+        self.batches[job].start()
+
+    def FindItem(self, job):
+        """
+        Return the current list entry of the job 'job' or -1 if it was deleted, entries
+        move when entries above them are deleted
+        """
+        for sel, item in enumerate(self.list_items):
+            if item["job"] == job:
+                return sel
+        return -1
+
     def OnAlign(self, event):
         sel = self.listbox.GetSelection()
         self.align.Disable()
         self.process.Disable()
         self.enfuse.Disable()
-        self.active_jobs[sel] = 1;
-        self.batch = blend(self, sel, MODE__ALIGN,
-                            self.list_items[sel]["path"],  
-                            self.list_items[sel]["files"], 
-                            self.list_items[sel]["settings"]["align"])
-        self.batch.start()    
+        self.focus.Disable()
+        self.StartJob(sel, MODE__ALIGN)
     
     def OnProcess(self, event):
         sel = self.listbox.GetSelection()
         self.align.Disable()
         self.process.Disable()
         self.enfuse.Disable()
-        self.active_jobs[sel] = 1;
-        self.batch = blend(self, sel, MODE__LUMINOSITY_MASKS,
-                           self.list_items[sel]["path"],
-                           self.list_items[sel]["files"],
-                           self.list_items[sel]["settings"]["align"])
-        self.batch.start()
+        self.focus.Disable()
+        self.StartJob(sel, MODE__LUMINOSITY_MASKS)
         print "Start blending (main GUI thread)"
 
     def OnEnfuse(self, event):
@@ -439,83 +651,796 @@ class MainWindow(wx.Frame):
         ## TODO: check if enfuse is available at all before invoking it
         #
         sel = self.listbox.GetSelection()
-        self.active_jobs[sel] = 1;
         self.align.Disable()
         self.process.Disable()
         self.enfuse.Disable()
-        self.batch = blend(self, sel, MODE__ENFUSE,
-                           self.list_items[sel]["path"],  
-                           self.list_items[sel]["files"],
-                           self.list_items[sel]["settings"]["align"])
-        self.batch.start()
+        self.focus.Disable()
+        self.StartJob(sel, MODE__ENFUSE)
+
+    def OnFocus(self, event):
+        sel = self.listbox.GetSelection()
+        self.align.Disable()
+        self.process.Disable()
+        self.enfuse.Disable()
+        self.focus.Disable()
+        self.StartJob(sel, MODE__FOCUS_STACK)
+
+    def OnResume(self, event):
+        # restart all jobs which were interrupted by a crash
+        self.resume.Disable()
+        for sel, item in enumerate(self.list_items):
+            if item["mode"] is not None and self.active_jobs[sel] == 0:
+                self.StartJob(sel, item["mode"])
+
+    def OnJobProgress(self, event):
+        record = event.GetValue()
+        sel = self.FindItem(record["job"])
+        self.progress.SetValue(int(record["progress"] * 100))
+        if record["event"] == "end":
+            self.status.SetLabel("Entry %s: %s took %.1fs (%d kB read, %d kB written)" %
+                                 (sel, record["stage"], record["seconds"],
+                                  record["bytes_read"] / 1024, record["bytes_written"] / 1024))
+        elif record["event"] == "done":
+            self.status.SetLabel("Entry %s: done after %.1fs" % (sel, record["seconds"]))
+        else:
+            self.status.SetLabel("Entry %s: %s..." % (sel, record["stage"]))
 
     def OnJobDone(self, event):
-        sel = event.GetValue()
-        print "Processing of list entry %s done" % (sel)
-        self.active_jobs[sel] = 0
+        job = event.GetValue()
+        sel = self.FindItem(job)
+        print "Processing of list entry %s (job %s) done" % (sel, job)
+        if sel != -1:
+            self.active_jobs[sel] = 0
+            self.list_items[sel]["mode"] = None
         self.align.Enable()
         self.process.Enable()
         self.enfuse.Enable()
-        self.batch.join()
+        self.focus.Enable()
+        self.batches.pop(job).join()
+
+
+def free_memory_mb():
+    """
+    Return the available RAM in MB
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return DEFAULT_FREE_MEMORY_MB
+
+
+def estimate_memory_mb(path, files, frames=None):
+    """
+    Estimate the memory a blending job needs from the image dimensions of the stack,
+    only the image headers are read. 'frames' limits the number of frames which are
+    in memory at the same time.
+    """
+    pixels = 0
+    for file in files[:frames]:
+        if exposure_engine and exposure_engine.is_native_format(file):
+            height, width = exposure_engine.load_frame_size(path+file)
+        else:
+            width, height = Image.open(path+file).size
+        pixels += width * height
+    return max(MIN_JOB_MEMORY_MB, pixels * MEMORY_PER_PIXEL / (1024 * 1024))
+
+
+class ResourceScheduler(object):
+    """
+    Admits blending jobs only when their estimated memory use fits into the memory
+    which is not yet granted to other running jobs. A job which is larger than the
+    whole budget is started alone and gets the whole budget.
+
+    Without a fixed 'budget_mb' the budget is MEMORY_FRACTION of the RAM which is free
+    when a job is admitted plus the memory granted to the running jobs (which is in
+    use by them or about to be), so it follows the memory use of gimp and other
+    programs during long sessions.
+    """
+    RECHECK_SECONDS = 5.0           # waiting jobs look at the free RAM again this often
+
+    def __init__(self, budget_mb=None):
+        self.fixed_budget = budget_mb
+        self.granted = 0
+        self.condition = threading.Condition()
+
+    def budget(self):
+        if self.fixed_budget is not None:
+            budget_mb = self.fixed_budget
+        else:
+            budget_mb = int((free_memory_mb() + self.granted) * MEMORY_FRACTION)
+        return max(MIN_JOB_MEMORY_MB, budget_mb)
+
+    def admit(self, memory_mb):
+        """
+        Block until 'memory_mb' can be granted, returns the granted amount in MB
+        """
+        with self.condition:
+            while True:
+                budget = self.budget()
+                granted = min(memory_mb, budget)
+                if self.granted == 0 or self.granted + granted <= budget:
+                    break
+                self.condition.wait(self.RECHECK_SECONDS)
+            self.granted += granted
+        return granted
+
+    def release(self, memory_mb):
+        with self.condition:
+            self.granted -= memory_mb
+            self.condition.notify_all()
+
+
+def enfuse_memory_params(memory_mb):
+    """
+    Return the enfuse cache size parameter (-m, in MB) for a job with 'memory_mb' MB.
+    The block size of the cache (-b, in KB) keeps the enfuse default.
+    """
+    return ["-m", str(max(1, memory_mb))]
+
+
+scheduler = ResourceScheduler()
+
+
+def stat_signature(filename):
+    """
+    Return size and modification time of a file, used to detect changed files
+    """
+    st = os.stat(filename)
+    return [st.st_size, int(st.st_mtime)]
+
+
+_alignment_lock = threading.Lock()
+
+# planar intermediates of the running jobs with the number of jobs using them, they are
+# never evicted from PLANES_CACHE_DIR
+_planes_in_use = {}
+_planes_lock = threading.Lock()
+
+
+class ResultCache(object):
+    """
+    Content-addressed store for aligned intermediates and blended results. Every entry
+    is a directory named after its key which contains the cached files and a manifest
+    with their original names (in order). The modification time of the manifest is
+    used as access time for the LRU eviction.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory, size_mb):
+        self.directory = os.path.expanduser(directory)
+        self.size = size_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.digests = {}
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def file_digest(self, filename):
+        """
+        Return the SHA-1 of a file, digests are remembered as long as the size and
+        modification time of the file don't change
+        """
+        signature = (filename,) + tuple(stat_signature(filename))
+        if signature in self.digests:
+            return self.digests[signature]
+        digest = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ""):
+                digest.update(chunk)
+        self.digests[signature] = digest.hexdigest()
+        return self.digests[signature]
+
+    def key(self, filenames, mode, settings):
+        """
+        Return the cache key for the given input files, blending mode and settings
+        """
+        digests = [self.file_digest(f) for f in filenames]
+        return hashlib.sha1(json.dumps([digests, mode, settings], sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        """
+        Return a list of (cached file, original name) tuples or None if not cached
+        """
+        manifest = os.path.join(self.directory, key, self.MANIFEST)
+        with self.lock:
+            try:
+                with open(manifest) as f:
+                    names = json.load(f)
+                os.utime(manifest, None)
+            except (IOError, OSError, ValueError):
+                return None
+        return [(os.path.join(self.directory, key, name), name) for name in names]
+
+    def put(self, key, filenames):
+        """
+        Store copies of 'filenames' under 'key' and evict old entries if necessary
+        """
+        names = [os.path.basename(f) for f in filenames]
+        tmp_dir = tempfile.mkdtemp(dir=self.directory, prefix=".tmp")
+        for filename, name in zip(filenames, names):
+            shutil.copy2(filename, os.path.join(tmp_dir, name))
+        with open(os.path.join(tmp_dir, self.MANIFEST), "w") as f:
+            json.dump(names, f)
+        with self.lock:
+            entry = os.path.join(self.directory, key)
+            if os.path.exists(entry):
+                shutil.rmtree(tmp_dir)
+            else:
+                os.rename(tmp_dir, entry)
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits into its size
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            manifest = os.path.join(self.directory, key, self.MANIFEST)
+            if not os.path.exists(manifest):
+                continue
+            entry_dir = os.path.join(self.directory, key)
+            size = sum(os.path.getsize(os.path.join(entry_dir, name))
+                       for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(manifest), size, entry_dir))
+            total += size
+        entries.sort()
+        while total > self.size and entries:
+            atime, size, entry_dir = entries.pop(0)
+            print "--- Removing %s from the result cache" % entry_dir
+            shutil.rmtree(entry_dir, True)
+            total -= size
+
+
+result_cache = None
+if USE_RESULT_CACHE:
+    result_cache = ResultCache(CACHE_DIR, CACHE_SIZE_MB)
+
+def file_bytes(filenames):
+    """
+    Return the total size of the given files, missing files are ignored
+    """
+    return sum(os.path.getsize(f) for f in filenames if os.path.exists(f))
+
+
+class JobJournal(object):
+    """
+    Append-only journal of the job list. Every change is appended as JSON line and
+    synced to disk, replaying the journal restores the jobs after a crash.
+    The states of a job are "new", "queued", "running", "done" and "failed".
+    """
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def add(self, item):
+        self.append({"op": "add", "job": item["job"], "path": item["path"],
+                     "files": item["files"], "settings": item["settings"]})
+
+    def update(self, job, settings):
+        self.append({"op": "settings", "job": job, "settings": settings})
+
+    def state(self, job, state, mode):
+        self.append({"op": "state", "job": job, "state": state, "mode": mode})
+
+    def delete(self, job):
+        self.append({"op": "delete", "job": job})
+
+    def load(self):
+        """
+        Replay the journal and return the jobs which are not done, in the order they
+        were added. Jobs which were queued or running when the journal ended have their
+        mode set, so they can be resumed.
+        """
+        jobs = {}
+        order = []
+        try:
+            with open(self.filename) as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue                    # torn last record of a crash
+            job = record["job"]
+            if record["op"] == "add":
+                settings = dict(DEFAULT_SETTINGS)
+                settings.update(record["settings"])
+                jobs[job] = {"job": job, "mode": None, "state": "new", "path": record["path"],
+                             "files": record["files"], "settings": settings}
+                order.append(job)
+            elif job not in jobs:
+                continue
+            elif record["op"] == "settings":
+                jobs[job]["settings"].update(record["settings"])
+            elif record["op"] == "state":
+                jobs[job]["state"] = record["state"]
+                jobs[job]["mode"] = record["mode"]
+            elif record["op"] == "delete":
+                del jobs[job]
+        items = []
+        for job in order:
+            if job in jobs and jobs[job]["state"] != "done":
+                item = jobs.pop(job)
+                if item.pop("state") not in ("queued", "running"):
+                    item["mode"] = None
+                items.append(item)
+        return items
+
+    def compact(self, items):
+        """
+        Atomically replace the journal with one that only contains the given jobs
+        """
+        with self.lock:
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, "w") as f:
+                for item in items:
+                    f.write(json.dumps({"op": "add", "job": item["job"], "path": item["path"],
+                                        "files": item["files"], "settings": item["settings"]}) + "\n")
+                    if item["mode"] is not None:
+                        f.write(json.dumps({"op": "state", "job": item["job"], "state": "queued",
+                                            "mode": item["mode"]}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_filename, self.filename)
+
+
+journal = None
+if JOURNAL_FILE:
+    journal = JobJournal(JOURNAL_FILE)
+
+
+def resume_jobs():
+    """
+    Run all jobs of the journal which were interrupted, without GUI
+    """
+    threads = []
+    jobs = journal.load()
+    # drops a torn last record, so the records of the resumed jobs start on a new line
+    journal.compact(jobs)
+    for item in jobs:
+        if item["mode"] is not None:
+            print "--- Resuming %s%s" % (item["path"], item["files"])
+            threads.append(blend(None, len(threads), item["mode"], item["path"], item["files"],
+                                 item["settings"], item["job"]))
+            threads[-1].start()
+    for thread in threads:
+        thread.join()
+
+
+# pipeline slots of the stages, see MAX_IO_STAGES / MAX_CPU_STAGES
+_io_slots  = threading.BoundedSemaphore(MAX_IO_STAGES)
+_cpu_slots = threading.BoundedSemaphore(MAX_CPU_STAGES or multiprocessing.cpu_count())
+PIPELINE_SLOTS = {"ingest":  _io_slots,
+                  "align":   _cpu_slots,        # align_image_stack or the native aligner
+                  "convert": _io_slots,
+                  "sort":    _io_slots,
+                  "decode":  _io_slots,
+                  "save":    _io_slots,
+                  "blend":   _cpu_slots}
+
+
+_telemetry_lock = threading.Lock()
+
+
+class JobTelemetry(object):
+    """
+    Collects timings, bytes read and written and the runtimes of external tools for
+    the stages of a job. Every stage is written as JSON line to TELEMETRY_LOG and posted
+    as progress event to the GUI (if there is one).
+    """
+    def __init__(self, parent, job, path, mode, stages):
+        self.parent = parent
+        self.job = job
+        self.path = path
+        self.mode = mode
+        self.stages = stages                # planned stages, the progress is based on them
+        self.done = 0
+        self.current = None
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def progress(self):
+        return min(1.0, float(self.done) / max(1, len(self.stages)))
+
+    @contextlib.contextmanager
+    def stage(self, name, read=()):
+        """
+        Context for a stage of the job, the caller adds the files it writes to the
+        "written" list of the yielded dict and the files it reads besides 'read' to
+        the "read" list
+        """
+        info = {"read": list(read), "written": [], "tools": []}
+        # the files given in 'read' are measured now, the stage may remove them
+        bytes_read = file_bytes(read)
+        self.current = info
+        started = time.time()
+        self.emit({"event": "start", "stage": name})
+        try:
+            yield info
+        finally:
+            self.current = None
+            if name in self.stages:
+                self.done += 1
+            self.emit({"event": "end", "stage": name,
+                       "seconds": round(time.time() - started, 3),
+                       "bytes_read": bytes_read + file_bytes(info["read"][len(read):]),
+                       "bytes_written": file_bytes(info["written"]),
+                       "tools": info["tools"]})
+
+    def run(self, command, **kwargs):
+        """
+        Run an external program and record its runtime in the current stage
+        """
+        started = time.time()
+        output = subprocess.Popen(command, **kwargs).communicate()[0]
+        with self.lock:
+            if self.current is not None:
+                self.current["tools"].append({"tool": os.path.basename(command[0]),
+                                              "seconds": round(time.time() - started, 3)})
+        return output
+
+    def finish(self):
+        self.done = len(self.stages)
+        self.emit({"event": "done", "seconds": round(time.time() - self.started, 3)})
+
+    def emit(self, record):
+        record.update({"job": self.job, "path": self.path, "mode": self.mode,
+                       "time": round(time.time(), 3), "progress": self.progress()})
+        if TELEMETRY_LOG:
+            with _telemetry_lock:
+                with open(os.path.expanduser(TELEMETRY_LOG), "a") as log:
+                    log.write(json.dumps(record) + "\n")
+        if self.parent:
+            wx.PostEvent(self.parent, BlendDoneEvent(myEVT_JOB_PROGRESS, -1, record))
+
+
+_blend_pool = None
+_blend_pool_lock = threading.Lock()
+
+def blend_pool():
+    """
+    Return the process pool for the native blending engines, created on first use
+    and shared by all blend threads
+    """
+    global _blend_pool
+    with _blend_pool_lock:
+        if _blend_pool is None:
+            _blend_pool = multiprocessing.Pool(MAX_BLEND_WORKERS or multiprocessing.cpu_count())
+    return _blend_pool
 
 
 class blend(threading.Thread):
-    def __init__(self, parent, task, mode, root, files, align=0):
+    def __init__(self, parent, task, mode, root, files, settings=DEFAULT_SETTINGS, job=None):
         self.id = task
+        self.job = job                      # id of the job in the journal
         self.mode = mode
         self.parent = parent
         self.path = root
         self.files = files                  # sorted to: dark_exp, normal_exp, bright_exp
-        self._align = align
+        self.planes = {}                    # planar intermediates of the files (see source())
+        self.settings = settings
+        self.raw = bool(exposure_engine) and any(exposure_engine.is_raw(f) for f in files)
+        self._align = settings["align"]
+        self.keep_tiff = settings["keep_tiff"] # feed aligned TIFFs to the blending step
         self.prefix="aligned"
-        self.blur_radius = 8
-        self.blur_typ = 0                   # 0 - Gaussian / None
-                                            # 1 - Selective / Low
-                                            # 2 - Selective / Medium
-                                            # 3 - Selective / High
-        self.dark_mask_grayscale = 0        # 0 - dark
-                                            # 1 - normal
-                                            # 2 - bright
-        self.bright_mask_grayscale = 0      # 0 - bright (inverted)
-                                            # 1 - normal (inverted)
-                                            # 2 - dark (inverted)
-        self.dark_takes_precedence = 0      # 0 - disabled
-                                            # 1 - enabled
-        self.auto_trim_mask_histograms = 0  # 0 - disabled
-                                            # 1 - enabled
-        self.scale_largest_dim_to = ""
+        self.blur_radius = settings["blur_radius"]
+        self.blur_typ = settings["blur"]                     # 0 - Gaussian / None
+                                                             # 1 - Selective / Low
+                                                             # 2 - Selective / Medium
+                                                             # 3 - Selective / High
+        self.dark_mask_grayscale = settings["dark_mask"]     # 0 - dark
+                                                             # 1 - normal
+                                                             # 2 - bright
+        self.bright_mask_grayscale = settings["bright_mask"] # 0 - bright (inverted)
+                                                             # 1 - normal (inverted)
+                                                             # 2 - dark (inverted)
+        self.dark_takes_precedence = settings["dark"]        # 0 - disabled
+                                                             # 1 - enabled
+        self.auto_trim_mask_histograms = settings["trim"]    # 0 - disabled
+                                                             # 1 - enabled
+        self.scale_largest_dim_to = settings["scale"]
         threading.Thread.__init__(self)
 
     def run(self):
         print "Los gehts!"
-        os.chdir(self.path)
-        self.start_blend()
-        evt = BlendDoneEvent(myEVT_JOB_DONE, -1, self.id)
-        wx.PostEvent(self.parent, evt)               
+        self.telemetry = JobTelemetry(self.parent, self.job, self.path, self.mode,
+                                      self.planned_stages())
+        self.scratch = None
+        self.memory = 0
+        state = "failed"
+        # everything which can fail (e.g. the files of a resumed job have moved) runs
+        # inside the try, so the job is always cleaned up, journaled and reported done
+        try:
+            # all paths are absolute, jobs never change the working directory of the process
+            self.scratch = tempfile.mkdtemp(prefix="collect_exposures-", dir=SCRATCH_DIR or None)
+            self.journal_state("queued")
+            frames = INCREMENTAL_FUSION_FRAMES if self.incremental() else None
+            self.memory = scheduler.admit(estimate_memory_mb(self.path, self.files, frames))
+            print "--- Job %s got %d MB of memory" % (self.id, self.memory)
+            self.journal_state("running")
+            self.start_blend()
+            state = "done"
+        finally:
+            try:
+                if self.memory:
+                    scheduler.release(self.memory)
+                self.release_planes()
+                if self.scratch:
+                    shutil.rmtree(self.scratch, True)
+                self.telemetry.finish()
+                self.journal_state(state)
+            finally:
+                if self.parent:
+                    evt = BlendDoneEvent(myEVT_JOB_DONE, -1, self.job)
+                    wx.PostEvent(self.parent, evt)
+
+    @contextlib.contextmanager
+    def stage(self, name, read=(), cpu=False):
+        """
+        Run a stage of the job: wait for a free pipeline slot, then record it. 'cpu'
+        takes a CPU slot for a stage which is usually I/O bound.
+        """
+        with (_cpu_slots if cpu else PIPELINE_SLOTS[name]):
+            with self.telemetry.stage(name, read) as info:
+                yield info
+
+    def journal_state(self, state):
+        if journal and self.job:
+            journal.state(self.job, state, self.mode)
+
+    def planned_stages(self):
+        stages = []
+        if self.raw:
+            stages.append("ingest")
+        if (self._align == 1) or (self.mode == MODE__ALIGN):
+            stages.append("align")
+            if not self.native_alignment():
+                stages.append("convert")
+        if self.mode == MODE__LUMINOSITY_MASKS:
+            stages.append("sort")
+        if self.native_blend() and self.mode != MODE__LUMINOSITY_MASKS and not self.incremental():
+            stages.append("decode")
+        if self.mode != MODE__ALIGN:
+            stages += ["blend", "save"]
+        return stages
 
     def align(self):
         """
         Align bracketed files with the help of the tool 'align_image_stack', which
-        is part of the hugin stitching suite. Only recommended when bracketed images
-        have been created handheld
-        """
-        count=0
-        files=[]
-        command=[CMD__ALIGN_IMAGE_STACK, "-a", self.prefix]
-        command.extend(self.files)
-        output = subprocess.Popen(command).communicate()[0]
-        for file in self.files:
-            tmp_filename=self.prefix+str(count).zfill(4)+".tif"
-            new_filename=file.rsplit(".",1)[0]+"_"+self.prefix
-            files.append(new_filename+".jpg")
-            os.rename(tmp_filename,new_filename+".tif")
-            command=[CMD__MOGRIFY,"-format","jpg","-quality","100",new_filename+".tif"]
-            output = subprocess.Popen(command).communicate()[0]
-            command=[CMD__JHEAD,"-te",file,new_filename+".jpg"]
-            output = subprocess.Popen(command).communicate()[0]
-            os.remove(new_filename+".tif")
-            count+=1
+        is part of the hugin stitching suite, or the native aligner of exposure_engine.
+        Only recommended when bracketed images have been created handheld
+        """
+        with self.stage("align", [self.path+f for f in self.files]) as stage:
+            sources = self.files
+            alignment = self.load_alignment() or {}
+            if alignment.get("files"):
+                print "--- Reusing aligned files of a previous job"
+                self.files = alignment["files"]
+                return
+            if self.planar():
+                with _planes_lock:
+                    # looked up again, other jobs may have written or evicted them meanwhile
+                    planes = (self.load_alignment() or {}).get("planes")
+                    reuse = bool(planes)
+                    if not reuse:
+                        planes = self.planes_files(sources)
+                    self.use_planes(sources, planes)
+                    if not reuse:
+                        # make room first, the new files are the newest and must not go
+                        exposure_engine.evict_cache(os.path.dirname(planes[0]),
+                                                    PLANES_CACHE_SIZE_MB, _planes_in_use)
+                if reuse:
+                    print "--- Reusing planar intermediates of a previous job"
+                else:
+                    # incremental jobs are admitted for a few frames, so align one at a time
+                    exposure_engine.align_files([self.path+f for f in sources], planes,
+                                                1 if self.incremental() else self.workers())
+                    stage["written"] = planes
+                    self.save_alignment(sources, dict(alignment, planes=planes))
+                return
+            if result_cache:
+                key = result_cache.key([self.path+f for f in self.files], MODE__ALIGN,
+                                       {"keep_tiff": self.keep_tiff, "pil": USE_PIL_CONVERTER,
+                                        "native": self.native_alignment()})
+                cached = result_cache.get(key)
+                if cached:
+                    print "--- Using cached aligned files"
+                    self.files = self.restore_cached(cached)
+                    stage["written"] = [self.path+f for f in self.files]
+                    self.save_alignment(sources, dict(alignment, files=self.files))
+                    return
+            if self.native_alignment():
+                extension = ".tif" if self.keep_tiff else ".jpg"
+                files = [f.rsplit(".",1)[0]+"_"+self.prefix+extension for f in self.files]
+                exposure_engine.align_files([self.path+f for f in self.files],
+                                            [self.path+f for f in files],
+                                            1 if self.incremental() else self.workers())
+                stage["written"] = [self.path+f for f in files]
+            else:
+                command=[CMD__ALIGN_IMAGE_STACK, "-a", os.path.join(self.scratch, self.prefix)]
+                command.extend([self.path+f for f in self.files])
+                output = self.telemetry.run(command, cwd=self.scratch)
+        if not self.native_alignment():
+            # the TIFFs of align_image_stack, they are moved or removed by the conversion
+            tiffs = [self.aligned_tiff(count) for count in range(len(self.files))]
+            with self.stage("convert", tiffs) as stage:
+                # the conversions are independent of each other, so run them concurrently
+                workers = MAX_CONVERT_WORKERS or multiprocessing.cpu_count()
+                pool = ThreadPool(max(1, min(workers, len(self.files))))
+                try:
+                    files = pool.map(self.convert_aligned, range(len(self.files)))
+                finally:
+                    pool.close()
+                    pool.join()
+                stage["written"] = [self.path+f for f in files]
         self.files = files # update filenames
+        self.save_alignment(sources, dict(alignment, files=files))
+        if result_cache:
+            result_cache.put(key, [self.path+f for f in files])
+
+    def ingest(self):
+        """
+        Decode the RAW files of the stack into the RAW cache in parallel, the native
+        engines read them from there
+        """
+        raws = [self.path+f for f in self.files if exposure_engine.is_raw(f)]
+        with self.stage("ingest", raws) as stage:
+            print "--- Decoding %d RAW files..." % len(raws)
+            stage["written"] = blend_pool().map(exposure_engine.ingest_raw, raws)
+
+    def alignment_record(self, sources):
+        return "|".join(sources) + ("|tiff" if self.keep_tiff else "")
+
+    def planes_files(self, sources):
+        """
+        Return the planar intermediate files for the aligned frames of 'sources' in
+        PLANES_CACHE_DIR, named after the stack
+        """
+        directory = os.path.expanduser(PLANES_CACHE_DIR)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass # created by a concurrent job
+        stack = self.path + self.alignment_record(sources)
+        if isinstance(stack, unicode):
+            stack = stack.encode("utf-8")
+        stack = hashlib.sha1(stack).hexdigest()
+        return [os.path.join(directory, "%s_%d%s" % (stack, i, exposure_engine.PLANES_EXTENSION))
+                for i in range(len(sources))]
+
+    def use_planes(self, sources, planes):
+        """
+        Read the frames of 'sources' from the planar intermediates 'planes' and keep them
+        from being evicted until the job ends, call with _planes_lock held
+        """
+        # the names of the stack stay, only the frames are read from the planes
+        self.planes = dict(zip(sources, planes))
+        for filename in planes:
+            _planes_in_use[filename] = _planes_in_use.get(filename, 0) + 1
+
+    def release_planes(self):
+        with _planes_lock:
+            for filename in self.planes.values():
+                _planes_in_use[filename] -= 1
+                if not _planes_in_use[filename]:
+                    del _planes_in_use[filename]
+            self.planes = {}
+
+    def source(self, file):
+        """
+        Return the path a frame of the stack is read from, the planar intermediate of
+        the file if there is one
+        """
+        return self.planes.get(file, self.path+file)
+
+    def load_alignment(self):
+        """
+        Return the alignment recorded for this stack by an earlier job or None if there
+        is none or the source files have changed since. The alignment is a dict with the
+        aligned "files" in the stack directory and/or the planar intermediates ("planes")
+        in the order of the sources, aligned files which have changed or were removed
+        since are left out.
+        """
+        with _alignment_lock:
+            try:
+                with open(self.path+ALIGNMENT_MANIFEST) as f:
+                    record = json.load(f).get(self.alignment_record(self.files))
+            except (IOError, ValueError):
+                return None
+        if not record:
+            return None
+        def unchanged(names):
+            try:
+                return all(stat_signature(os.path.join(self.path, name)) ==
+                           record["signatures"].get(name) for name in names)
+            except OSError:
+                return False
+        if not unchanged(self.files):
+            return None
+        alignment = dict((kind, record[kind]) for kind in ("files", "planes")
+                         if record.get(kind) and unchanged(record[kind]))
+        return alignment or None
+
+    def save_alignment(self, sources, alignment):
+        """
+        Record the alignment (see load_alignment()) of the source files 'sources' in the
+        stack directory
+        """
+        names = sources + alignment.get("files", []) + alignment.get("planes", [])
+        signatures = dict((name, stat_signature(os.path.join(self.path, name))) for name in names)
+        with _alignment_lock:
+            try:
+                with open(self.path+ALIGNMENT_MANIFEST) as f:
+                    records = json.load(f)
+            except (IOError, ValueError):
+                records = {}
+            records[self.alignment_record(sources)] = dict(alignment, signatures=signatures)
+            with open(self.path+ALIGNMENT_MANIFEST, "w") as f:
+                json.dump(records, f)
+
+    def restore_cached(self, cached, names=None):
+        """
+        Copy cached files into the stack directory, by default under their original
+        names, and return the new filenames
+        """
+        files = []
+        for (cached_file, name), new_name in zip(cached, names or [n for c, n in cached]):
+            shutil.copy2(cached_file, self.path+new_name)
+            files.append(new_name)
+        return files
+
+    def aligned_tiff(self, count):
+        """
+        Return the TIFF align_image_stack writes for the file with index 'count'
+        """
+        return os.path.join(self.scratch, self.prefix+str(count).zfill(4)+".tif")
+
+    def convert_aligned(self, count):
+        """
+        Convert the aligned TIFF with index 'count' into a JPG next to the original file
+        and copy the EXIF data of the original over, or just keep the TIFF if requested.
+        Returns the new filename.
+        """
+        file=self.files[count]
+        tmp_filename=self.aligned_tiff(count)
+        new_filename=file.rsplit(".",1)[0]+"_"+self.prefix
+        if self.keep_tiff:
+            # skip the lossy JPG intermediate, enfuse and gimp read TIFFs just fine
+            shutil.move(tmp_filename, self.path+new_filename+".tif")
+            return new_filename+".tif"
+        if USE_PIL_CONVERTER:
+            im = Image.open(tmp_filename)
+            exif = Image.open(self.path+file).info.get("exif")
+            options = {"quality": 100, "subsampling": 0} # same as mogrify at quality 100
+            if exif:
+                options["exif"] = exif
+            im.convert("RGB").save(self.path+new_filename+".jpg", "JPEG", **options)
+        else:
+            tmp_jpg=tmp_filename.rsplit(".",1)[0]+".jpg"
+            command=[CMD__MOGRIFY,"-format","jpg","-quality","100",tmp_filename]
+            output = self.telemetry.run(command)
+            command=[CMD__JHEAD,"-te",self.path+file,tmp_jpg]
+            output = self.telemetry.run(command)
+            shutil.move(tmp_jpg, self.path+new_filename+".jpg")
+        os.remove(tmp_filename)
+        return new_filename+".jpg"
 
 
     def sort_exposures(self):
@@ -523,65 +1448,211 @@ class blend(threading.Thread):
         Sort files in this order (dark to bright): dark_exp, normal_exp, bright_exp
         according to the histogram mean value of the blue channel with index 2 (R, G, B)
         Return the sorted files, does not change self.files!
+        Stacks with more than three exposures are sorted the same way.
         """
-        files = []
-        means = []
         hist_mean = {}             
-        os.chdir(self.path)
         print "--- Sorting bracketing exposures..."
         for file in self.files:
-            im   = Image.open(self.path+file)
+            if exposure_engine and exposure_engine.is_native_format(self.source(file)):
+                # only the blue plane of a planar file is read
+                blue = exposure_engine.load_channel(self.source(file), 2)
+                hist_mean[file] = int(blue.mean() * 255)
+                continue
+            im   = Image.open(self.source(file))
             stat = ImageStat.Stat(im)
             hist_mean[file] = int(stat.mean[2])
-            means.append(int(stat.mean[2]))
-        means.sort()        
-        for m in means:
-            for hist_f, hist_m in hist_mean.iteritems():
-                if(hist_m == m):
-                    print "Mean histogram value: %d (image: %s)" % (m, hist_f)
-                    files.append(hist_f)
+        # sorting the files (not the means) keeps exposures with the same mean apart
+        files = sorted(self.files, key=lambda f: hist_mean[f])
+        for file in files:
+            print "Mean histogram value: %d (image: %s)" % (hist_mean[file], file)
         return files
 
 
-    def start_blend(self):
+    def output_filename(self, file, suffix):
+        """
+        Return the first filename derived from 'file' with 'suffix' and a counter
+        which does not exist yet
+        """
         i = 0
-        if (self._align == 1) or (self.mode == MODE__ALIGN):
+        filename = file.rsplit(".",1)[0]+suffix+str(i)+".jpg"
+        while os.path.exists(self.path+filename):
+            i += 1
+            filename = file.rsplit(".",1)[0]+suffix+str(i)+".jpg"
+        return filename
+
+    def native_blend(self):
+        """
+        Return whether the blending mode of this job runs in the native engine
+        """
+        if not exposure_engine:
+            return False
+        if self.raw:
+            return self.mode != MODE__ALIGN
+        if self.mode == MODE__LUMINOSITY_MASKS:
+            return USE_NATIVE_LUMINOSITY_MASKS or not startedAsGimpPlugin
+        return self.mode in (MODE__ENFUSE, MODE__FOCUS_STACK) and USE_NATIVE_FUSION
+
+    def native_alignment(self):
+        """
+        Return whether the stack is aligned by the native engine
+        """
+        return bool(exposure_engine) and bool(USE_NATIVE_ALIGNMENT or self.raw)
+
+    def planar(self):
+        """
+        Return whether the aligned frames are written as planar intermediates
+        """
+        return bool(USE_PLANAR_INTERMEDIATES and self.mode != MODE__ALIGN and
+                    self.native_alignment() and self.native_blend())
+
+    def incremental(self):
+        """
+        Return whether the stack is fused frame by frame by the native engine
+        """
+        return (self.native_blend() and self.mode != MODE__LUMINOSITY_MASKS and
+                (self.mode == MODE__FOCUS_STACK or len(self.files) > INCREMENTAL_FUSION_FRAMES))
+
+    def enfuse_params(self):
+        """
+        Return the enfuse parameters for the mode of this job
+        """
+        if self.mode == MODE__FOCUS_STACK:
+            return PARAM__ENFUSE_DEFAULT + [p for p in PARAM__ENFUSE_FOCUS_STACKING
+                                            if p not in PARAM__ENFUSE_DEFAULT]
+        return PARAM__ENFUSE_DEFAULT
+
+    def result_key(self):
+        """
+        Return the result cache key of this job or None if the result can't be cached,
+        i.e. when alignment is the only step or the result is an image in gimp
+        """
+        if not result_cache or self.mode == MODE__ALIGN:
+            return None
+        if self.mode == MODE__LUMINOSITY_MASKS and not self.native_blend():
+            return None
+        settings = dict((name, self.settings.get(name, DEFAULT_SETTINGS[name]))
+                        for name in RESULT_SETTINGS[self.mode])
+        engine = {"settings": settings,
+                  "enfuse": self.enfuse_params(),
+                  "native_fusion": bool(USE_NATIVE_FUSION and exposure_engine),
+                  "native_alignment": self.native_alignment(),
+                  "pil": USE_PIL_CONVERTER}
+        return result_cache.key([self.path+f for f in self.files], self.mode, engine)
+
+    def start_blend(self):
+        key = self.result_key()
+        if key:
+            cached = result_cache.get(key)
+            if cached:
+                with self.stage("save") as stage:
+                    cached_file, name = cached[0]
+                    suffix = OUTPUT_SUFFIX[self.mode]
+                    output = self.output_filename(name.rsplit(suffix, 1)[0]+".jpg", suffix)
+                    print "--- Using cached result for %s" % output
+                    self.restore_cached(cached, [output])
+                    stage["written"] = [self.path+output]
+                return
+        if self.raw:
+            self.ingest()
+        # the native blending engines align in memory, unless aligned files exist already
+        align_in_engine = (self._align == 1 and self.mode != MODE__ALIGN and
+                           self.native_alignment() and self.native_blend() and
+                           not self.planar() and
+                           not (self.load_alignment() or {}).get("files"))
+        if ((self._align == 1) or (self.mode == MODE__ALIGN)) and not align_in_engine:
             print "--- Aligning bracketing exposures..."
             self.align()
             print "--- Alignment finised"        
+        if self.mode == MODE__ALIGN:
+            return
+        files = self.files
+        frames = None
+        if (self.mode == MODE__LUMINOSITY_MASKS):
+            with self.stage("sort", [self.source(f) for f in self.files]):
+                files = self.sort_exposures()
+        elif self.native_blend() and not self.incremental():
+            # decode (and align) outside of the blend stage, so this overlaps with
+            # the blending of other stacks
+            with self.stage("decode", [self.source(f) for f in files], cpu=align_in_engine):
+                frames = exposure_engine.load_frames([self.source(f) for f in files],
+                                                     align_in_engine, self.workers())
+        with self.stage("blend", [self.source(f) for f in files]) as stage:
+            output = self.blend_exposures(files, align_in_engine, frames)
+            if output:
+                stage["written"] = [self.path+output]
+        with self.stage("save") as stage:
+            if key and output and os.path.exists(self.path+output):
+                result_cache.put(key, [self.path+output])
+                stage["read"] = [self.path+output]
+
+    def workers(self):
+        return MAX_FUSION_WORKERS or multiprocessing.cpu_count()
+
+    def blend_exposures(self, files, align_in_engine=False, frames=None):
+        """
+        Blend the (sorted) files according to the mode of this job, returns the
+        filename of the result or None if the result is an image in gimp.
+        The native fusion uses the already decoded 'frames'.
+        """
+        output = None
         if (self.mode == MODE__LUMINOSITY_MASKS):
-            files = self.sort_exposures()
             print "files:"
             print files
             print "self.files:"
             print self.files
-            print "normal exp: %s" % self.path+files[1]
-            print "dark  exp: %s"  % self.path+files[0]
-            print "bright exp: %s" % self.path+files[2]
-            pdb.script_fu_exposure_blend(self.path+files[1], # normal_exp
-                                         self.path+files[0], # dark_exp
-                                         self.path+files[2], # bright_exp,
-                                         self.blur_radius,
-                                         self.blur_typ,
-                                         self.dark_mask_grayscale,
-                                         self.bright_mask_grayscale,
-                                         self.dark_takes_precedence,
-                                         self.auto_trim_mask_histograms,
-                                         self.scale_largest_dim_to
-                                         )
-        elif (self.mode == MODE__ENFUSE):
-            files = self.files
-            enfuse_filename = files[0].rsplit(".",1)[0]+"_enfuse"+str(i)+".jpg"
-            while os.path.exists(enfuse_filename):
-                i += 1
-                enfuse_filename = files[0].replace(".jpg", "")+"_enfuse"+str(i)+".jpg"
+            # with more than three exposures the darkest, middle and brightest are blended
+            files = [files[0], files[len(files) // 2], files[-1]]
+            print "normal exp: %s" % self.source(files[1])
+            print "dark  exp: %s"  % self.source(files[0])
+            print "bright exp: %s" % self.source(files[2])
+            if self.native_blend():
+                blend_filename = self.output_filename(files[1], OUTPUT_SUFFIX[self.mode])
+                print "--- Blending exposures to %s (native engine)" % blend_filename
+                blend_pool().apply(exposure_engine.luminosity_blend_files,
+                                   (self.source(files[1]), self.source(files[0]),
+                                    self.source(files[2]), self.path+blend_filename, self.settings, align_in_engine))
+                output = blend_filename
+            else:
+                pdb.script_fu_exposure_blend(self.path+files[1], # normal_exp
+                                             self.path+files[0], # dark_exp
+                                             self.path+files[2], # bright_exp,
+                                             self.blur_radius,
+                                             self.blur_typ,
+                                             self.dark_mask_grayscale,
+                                             self.bright_mask_grayscale,
+                                             self.dark_takes_precedence,
+                                             self.auto_trim_mask_histograms,
+                                             self.scale_largest_dim_to
+                                             )
+        elif self.mode in (MODE__ENFUSE, MODE__FOCUS_STACK):
+            enfuse_filename = self.output_filename(files[0], OUTPUT_SUFFIX[self.mode])
             # add the following constants as arguments:
             # - PARAM__ENFUSE_EXPOSURE_SERIES
             # - PARAM__ENFUSE_DEFAULT
-            command = [CMD__ENFUSE] + PARAM__ENFUSE_DEFAULT + ["-o", enfuse_filename]
-            command.extend(files)
-            print "command: '%s'" % " ".join(command)
-            output = subprocess.Popen(command).communicate()[0]
+            weights = exposure_engine and exposure_engine.enfuse_weights(self.enfuse_params())
+            if self.incremental():
+                print "--- Fusing %d frames to %s (native engine, incremental)" % (len(files),
+                                                                                 enfuse_filename)
+                fused = exposure_engine.fuse_incremental([self.source(f) for f in files], weights,
+                                                         align_in_engine)
+                exposure_engine.save_frame(fused, self.path+enfuse_filename)
+            elif self.native_blend():
+                print "--- Fusing exposures to %s (native engine)" % enfuse_filename
+                height, width = frames[0].shape[:2]
+                tile_rows = exposure_engine.tile_rows_for_memory(width, height, len(frames),
+                                                                 self.memory, self.workers())
+                fused = exposure_engine.fuse_tiled(frames, weights,
+                                                   min(FUSION_TILE_ROWS, tile_rows), self.workers())
+                exposure_engine.save_frame(fused, self.path+enfuse_filename)
+            else:
+                command = [CMD__ENFUSE] + self.enfuse_params() + enfuse_memory_params(self.memory)
+                command += ["-o", self.path+enfuse_filename]
+                command.extend([self.path+f for f in files])
+                print "command: '%s'" % " ".join(command)
+                # enfuse saves its masks relative to its working directory
+                self.telemetry.run(command, cwd=self.path)
+            output = enfuse_filename
+        return output
 
         #filename = self.path + normal_exp.split(".")[0] + ".xcf"
         #cur_drawable = pdb.gimp_image_get_active_drawable(img)
@@ -630,6 +1701,8 @@ if __name__ == '__main__':
     if startedAsGimpPlugin:
         print "Started script as gimp plug-in!"
         ExposureBlendingBatch().start()
+    elif "--resume" in sys.argv[1:] and journal:
+        resume_jobs()
     else:
         app = wx.App()
         MainWindow(None, -1, 'Exposure Blending Batch')
@@ -0,0 +1,954 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#########################################################################################
+# exposure_engine.py
+#
+# Description:
+# ------------
+# Native image processing for collect_exposures.py, implemented with NumPy so that
+# exposure stacks can be blended without external programs or a running gimp.
+#
+# Documentation:
+# --------------
+#
+# Exposure fusion follows Mertens, Kautz, Van Reeth: "Exposure Fusion" (2007), which
+# is the algorithm enfuse implements as well. Every frame gets a per-pixel weight
+#
+#    w = contrast^wc * saturation^ws * well_exposedness^we
+#
+# and the frames are blended in a Laplacian pyramid with the Gaussian pyramid of
+# the normalized weights. The exponents are taken from the enfuse parameter lists in
+# collect_exposures.py (see enfuse_weights()), so the native engine and enfuse give
+# comparable results for the same mode.
+#
+# To bound memory use and to use all cores the image is fused in horizontal strips
+# which overlap by the footprint of the coarsest pyramid level, the strips are
+# processed by a pool of worker threads (NumPy releases the GIL in its inner loops).
+#
+# Intermediate frames (aligned frames, decoded RAW files) are stored in a planar
+# format which is read back memory-mapped without decoding:
+#
+#    PLANES_HEADER bytes header: magic, numpy dtype string, channels, height, width
+#    channels planes of height x width values (float32 or uint16, little endian)
+#
+# Aligned frames are stored as uint16 (PLANES_DTYPE), 6 bytes per pixel. load_frame()
+# converts them to float32 from the mapping without decoding, float32 planes are
+# returned as (strided) views of the mapping. load_channel() only reads one plane.
+# Concurrent jobs share the frames in the page cache of the OS.
+#
+# RAW files are decoded with rawpy (LibRaw) if it is installed. The decoder output is
+# 16-bit linear RGB, it is cached on disk below RAW_CACHE_DIR as planar file named after
+# the SHA-1 of the RAW file, so every RAW file is decoded only once. The SHA-1 is
+# remembered as long as size and modification time of the RAW file don't change. The
+# least recently used files are removed when the cache grows beyond RAW_CACHE_SIZE_MB.
+# Frames are gamma encoded with RAW_GAMMA when they are loaded, the fusion weights
+# assume display referred values.
+#
+#########################################################################################
+
+from PIL import Image
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import hashlib, math, os, struct, tempfile
+import numpy as np
+
+# RAW files are only supported with rawpy
+try:
+    import rawpy
+except ImportError:
+    rawpy = None
+
+# enfuse defaults for the weights if not given on the command line
+DEFAULT_WEIGHTS = {"exposure":   1.0,
+                   "saturation": 0.2,
+                   "contrast":   0.0,
+                   "hard_mask":  0}
+
+EXPOSURE_OPTIMUM = 0.5          # well-exposedness: center of the gaussian curve
+EXPOSURE_WIDTH   = 0.2          # well-exposedness: width of the gaussian curve
+MAX_LEVELS       = 7            # maximum number of pyramid levels
+TILE_ROWS        = 512          # default height of the strips which are fused in parallel
+WEIGHT_EPSILON   = 1e-12        # avoids division by zero for pixels without any weight
+FRAME_BYTES      = 12           # memory per pixel of a loaded float32 RGB frame
+STRIP_BYTES      = 64           # memory per pixel and frame while fusing a strip
+
+PLANES_EXTENSION = ".planes"
+PLANES_MAGIC     = b"EXPLANES"
+PLANES_HEADER    = 64           # size of the header, the planes start aligned behind it
+PLANES_DTYPE     = np.uint16    # type of the aligned frames, np.float32 doubles the size
+_PLANES_FORMAT   = "<8s8sIII"   # magic, dtype, channels, height, width
+
+RAW_FORMATS      = ["CR2", "CR3", "NEF", "NRW", "ARW", "DNG", "ORF", "RW2", "RAF", "PEF", "SRW"]
+RAW_GAMMA        = 2.2          # gamma applied to the linear RAW data when it is loaded
+RAW_CACHE_DIR    = os.path.join(tempfile.gettempdir(), "exposure_engine-raw")
+RAW_CACHE_SIZE_MB = 8192
+
+# 5-tap binomial kernel used to build the pyramids (same as Burt & Adelson)
+_KERNEL = np.array([1.0, 4.0, 6.0, 4.0, 1.0], dtype=np.float32) / 16.0
+
+
+def enfuse_weights(params):
+    """
+    Derive the fusion weights from a list of enfuse command line parameters,
+    e.g. PARAM__ENFUSE_FOCUS_STACKING. Parameters not given keep the enfuse defaults.
+    """
+    weights = dict(DEFAULT_WEIGHTS)
+    for param in params:
+        if param == "--hard-mask":
+            weights["hard_mask"] = 1
+        elif param.startswith("--") and "-weight=" in param:
+            name, value = param[2:].split("-weight=", 1)
+            if name in weights:
+                weights[name] = float(value)
+    return weights
+
+
+def load_frame(filename):
+    """
+    Load an image as float32 RGB array with values in the range [0, 1]
+    """
+    if is_raw(filename):
+        frame = load_raw(filename).astype(np.float32) / 65535.0
+        return np.power(frame, 1.0 / RAW_GAMMA, out=frame)
+    if is_planes(filename):
+        frame = load_planes(filename)
+        if frame.dtype == np.uint16:
+            return frame.astype(np.float32) / 65535.0
+        return frame
+    im = Image.open(filename)
+    if im.mode not in ("RGB", "I;16", "I"):
+        im = im.convert("RGB")
+    frame = np.asarray(im, dtype=np.float32)
+    if im.mode == "RGB":
+        return frame / 255.0
+    # 16-bit grayscale
+    frame = frame / 65535.0
+    return np.dstack((frame, frame, frame))
+
+
+def load_channel(filename, channel):
+    """
+    Load one channel of an image as float32 array with values in the range [0, 1], only
+    that plane of a planar file is read
+    """
+    if is_planes(filename):
+        plane = load_planes(filename)[:, :, channel]
+        if plane.dtype == np.uint16:
+            return plane.astype(np.float32) / 65535.0
+        return plane
+    return load_frame(filename)[:, :, channel]
+
+
+def load_frames(files, align=False, workers=0):
+    """
+    Decode the files of a stack in parallel and align them in memory if 'align' is set
+    """
+    pool = ThreadPool(max(1, min(len(files), workers or multiprocessing.cpu_count())))
+    try:
+        frames = pool.map(load_frame, files)
+    finally:
+        pool.close()
+        pool.join()
+    if align:
+        frames = align_frames(frames, workers)
+    return frames
+
+
+def load_frame_size(filename):
+    """
+    Return (height, width) of an image file, only the header is read
+    """
+    if is_raw(filename):
+        with rawpy.imread(filename) as raw:
+            sizes = raw.sizes
+        if sizes.flip in (5, 6): # rotated by 90 degrees
+            return sizes.width, sizes.height
+        return sizes.height, sizes.width
+    if is_planes(filename):
+        return load_planes(filename).shape[:2]
+    width, height = Image.open(filename).size
+    return height, width
+
+
+def is_raw(filename):
+    return filename.rsplit(".", 1)[-1].upper() in RAW_FORMATS
+
+
+def is_planes(filename):
+    return filename.endswith(PLANES_EXTENSION)
+
+
+def is_native_format(filename):
+    """
+    Return whether only the native engine can read the file
+    """
+    return is_raw(filename) or is_planes(filename)
+
+
+def save_planes(frame, filename, dtype=PLANES_DTYPE):
+    """
+    Save an RGB array in the planar intermediate format, float frames are expected in
+    the range [0, 1]. The file is written to a temporary file first and renamed, so
+    concurrent readers never see a partial file.
+    """
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if frame.dtype.kind == "f" and dtype.kind == "u":
+        frame = np.clip(frame * 65535.0 + 0.5, 0, 65535)
+    height, width, channels = frame.shape
+    header = struct.pack(_PLANES_FORMAT, PLANES_MAGIC, dtype.str.encode("ascii"),
+                         channels, height, width)
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_file = tempfile.mkstemp(suffix=PLANES_EXTENSION, prefix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header.ljust(PLANES_HEADER, b"\0"))
+            for channel in range(channels):
+                np.ascontiguousarray(frame[:, :, channel], dtype=dtype).tofile(f)
+        os.rename(tmp_file, filename)
+    except:
+        os.remove(tmp_file)
+        raise
+
+
+def load_planes(filename):
+    """
+    Return a planar intermediate file as read-only, memory-mapped height x width x
+    channels array (a view on the planes, nothing is read yet)
+    """
+    with open(filename, "rb") as f:
+        header = f.read(struct.calcsize(_PLANES_FORMAT))
+    magic, dtype, channels, height, width = struct.unpack(_PLANES_FORMAT, header)
+    if magic != PLANES_MAGIC:
+        raise IOError("%s is not a planar intermediate file" % filename)
+    planes = np.memmap(filename, dtype=np.dtype(dtype.rstrip(b"\0").decode("ascii")),
+                       mode="r", offset=PLANES_HEADER, shape=(channels, height, width))
+    return np.moveaxis(planes, 0, -1)
+
+
+# SHA-1 of the RAW files by (path, size, modification time)
+_raw_digests = {}
+
+
+def raw_cache_file(filename):
+    """
+    Return the cache file of the decoded RAW file 'filename'
+    """
+    st = os.stat(filename)
+    signature = (os.path.abspath(filename), st.st_size, st.st_mtime)
+    if signature not in _raw_digests:
+        digest = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _raw_digests[signature] = digest.hexdigest()
+    return os.path.join(RAW_CACHE_DIR, _raw_digests[signature] + PLANES_EXTENSION)
+
+
+def evict_cache(directory, size_mb, keep=()):
+    """
+    Remove the planar files of 'directory' with the oldest modification times until
+    the rest fits into 'size_mb', files which are being written and the files in 'keep'
+    (e.g. the ones running jobs will still open) are skipped
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith(".") or not is_planes(name) or os.path.join(directory, name) in keep:
+            continue
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue # removed by a concurrent job
+        entries.append((st.st_mtime, st.st_size, os.path.join(directory, name)))
+    entries.sort()
+    total = sum(size for mtime, size, filename in entries)
+    while total > size_mb * 1024 * 1024 and entries:
+        mtime, size, filename = entries.pop(0)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
+
+
+def decode_raw(filename):
+    """
+    Decode a RAW file to a uint16 RGB array with linear values (camera white balance,
+    no automatic brightening)
+    """
+    with rawpy.imread(filename) as raw:
+        return raw.postprocess(gamma=(1, 1), no_auto_bright=True, use_camera_wb=True,
+                               output_bps=16)
+
+
+def ingest_raw(filename):
+    """
+    Decode a RAW file into the cache unless it is cached already, returns the cache file
+    """
+    cache_file = raw_cache_file(filename)
+    try:
+        os.utime(cache_file, None) # the modification time is the access time of the LRU
+    except OSError:
+        if not os.path.isdir(RAW_CACHE_DIR):
+            try:
+                os.makedirs(RAW_CACHE_DIR)
+            except OSError:
+                pass # created by a concurrent job
+        save_planes(decode_raw(filename), cache_file, np.uint16)
+        evict_cache(RAW_CACHE_DIR, RAW_CACHE_SIZE_MB)
+    return cache_file
+
+
+def load_raw(filename):
+    """
+    Return the decoded RAW file as read-only, memory-mapped uint16 RGB array
+    """
+    return load_planes(ingest_raw(filename))
+
+
+def save_frame(frame, filename, quality=100):
+    """
+    Save a float RGB array with values in the range [0, 1] as 8-bit image
+    """
+    data = np.clip(frame * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    options = {}
+    if filename.upper().endswith(("JPG", "JPEG")):
+        options = {"quality": quality, "subsampling": 0}
+    Image.fromarray(data, "RGB").save(filename, **options)
+
+
+def _blur(img):
+    """
+    Separable 5-tap binomial blur along the first two axes with mirrored borders
+    """
+    pad = [(2, 2), (2, 2)] + [(0, 0)] * (img.ndim - 2)
+    padded = np.pad(img, pad, mode="reflect")
+    rows = sum(_KERNEL[i] * padded[i:i + img.shape[0]] for i in range(5))
+    return sum(_KERNEL[i] * rows[:, i:i + img.shape[1]] for i in range(5))
+
+
+def _reduce(img):
+    return _blur(img)[::2, ::2]
+
+
+def _expand(img, shape):
+    up = np.zeros(shape[:2] + img.shape[2:], dtype=img.dtype)
+    up[::2, ::2] = img
+    return _blur(up) * 4.0
+
+
+def gaussian_pyramid(img, levels):
+    pyramid = [img]
+    for i in range(levels - 1):
+        pyramid.append(_reduce(pyramid[-1]))
+    return pyramid
+
+
+def laplacian_pyramid(img, levels):
+    gauss = gaussian_pyramid(img, levels)
+    pyramid = []
+    for i in range(levels - 1):
+        pyramid.append(gauss[i] - _expand(gauss[i + 1], gauss[i].shape))
+    pyramid.append(gauss[-1])
+    return pyramid
+
+
+def collapse(pyramid):
+    img = pyramid[-1]
+    for level in reversed(pyramid[:-1]):
+        img = level + _expand(img, level.shape)
+    return img
+
+
+def pyramid_levels(height, width):
+    """
+    Number of pyramid levels for an image of the given size
+    """
+    return max(1, min(MAX_LEVELS, int(math.log(min(height, width), 2))))
+
+
+def fusion_weights(frame, weights):
+    """
+    Per-pixel Mertens weight of a single frame
+    """
+    w = np.ones(frame.shape[:2], dtype=np.float32)
+    if weights["contrast"]:
+        gray = frame.mean(axis=2)
+        padded = np.pad(gray, 1, mode="reflect")
+        laplace = (padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] +
+                   padded[1:-1, 2:] - 4.0 * gray)
+        w *= np.abs(laplace) ** weights["contrast"]
+    if weights["saturation"]:
+        w *= frame.std(axis=2) ** weights["saturation"]
+    if weights["exposure"]:
+        exposedness = np.exp(-(frame - EXPOSURE_OPTIMUM) ** 2 / (2 * EXPOSURE_WIDTH ** 2))
+        w *= exposedness.prod(axis=2) ** weights["exposure"]
+    return w + WEIGHT_EPSILON
+
+
+def fuse(frames, weights=DEFAULT_WEIGHTS, levels=None):
+    """
+    Fuse a list of float RGB frames of equal size, returns the fused frame
+    """
+    height, width = frames[0].shape[:2]
+    if levels is None:
+        levels = pyramid_levels(height, width)
+    w = np.array([fusion_weights(frame, weights) for frame in frames])
+    if weights["hard_mask"]:
+        # winner takes all: only the best frame contributes to every pixel
+        w = (w == w.max(axis=0)).astype(np.float32)
+    w /= w.sum(axis=0)
+    result = None
+    for frame, frame_weight in zip(frames, w):
+        gauss = gaussian_pyramid(frame_weight[:, :, np.newaxis], levels)
+        lapl = laplacian_pyramid(frame, levels)
+        blended = [g * l for g, l in zip(gauss, lapl)]
+        if result is None:
+            result = blended
+        else:
+            result = [r + b for r, b in zip(result, blended)]
+    return np.clip(collapse(result), 0.0, 1.0)
+
+
+def fuse_tiled(frames, weights=DEFAULT_WEIGHTS, tile_rows=TILE_ROWS, workers=0):
+    """
+    Fuse the frames in overlapping horizontal strips using a pool of worker threads.
+    All strips use the same number of pyramid levels as the whole image would, their
+    height is rounded down to a multiple of 2^levels so that the strips line up with
+    the downsampling grid of the pyramids (otherwise the strip edges show as bands).
+    """
+    height, width = frames[0].shape[:2]
+    levels = pyramid_levels(height, width)
+    overlap = 2 ** levels
+    tile_rows = max(overlap, tile_rows // overlap * overlap)
+    tiles = [(y, min(height, y + tile_rows)) for y in range(0, height, tile_rows)]
+
+    def fuse_tile(tile):
+        y0, y1 = tile
+        top = max(0, y0 - overlap)
+        bottom = min(height, y1 + overlap)
+        fused = fuse([frame[top:bottom] for frame in frames], weights, levels)
+        return fused[y0 - top:y1 - top]
+
+    if len(tiles) == 1:
+        return fuse(frames, weights, levels)
+    pool = ThreadPool(min(len(tiles), workers or multiprocessing.cpu_count()))
+    try:
+        strips = pool.map(fuse_tile, tiles)
+    finally:
+        pool.close()
+        pool.join()
+    return np.concatenate(strips, axis=0)
+
+
+def fuse_incremental(files, weights=DEFAULT_WEIGHTS, align=False):
+    """
+    Fuse an arbitrary number of image files while holding only one frame (plus the
+    reference frame for alignment) in memory. The blended pyramid and the pyramid of
+    the weight sums are accumulated frame by frame and normalized at the end, i.e.
+    sum(G(w_k) * L(I_k)) / sum(G(w_k)) instead of sum(G(w_k / sum(w)) * L(I_k)).
+
+    With a hard mask (focus stacking) the files are read twice: the first pass finds
+    the frame with the highest weight for every pixel, the second pass blends the
+    frames with these binary masks.
+    """
+    reference = load_frame(files[len(files) // 2]) if align else None
+    height, width = load_frame_size(files[0])
+    levels = pyramid_levels(height, width)
+    transforms = {}
+
+    def frame(index):
+        f = load_frame(files[index])
+        if align and index != len(files) // 2:
+            if index not in transforms:
+                transforms[index] = estimate_transform(reference, f)
+            f = warp_frame(f, transforms[index])
+        return f
+
+    if weights["hard_mask"]:
+        best = np.zeros((height, width), dtype=np.float32)
+        winner = np.zeros((height, width), dtype=np.int16)
+        for index in range(len(files)):
+            w = fusion_weights(frame(index), weights)
+            better = w > best
+            best[better] = w[better]
+            winner[better] = index
+        del best
+    blended = None
+    weight_sum = None
+    for index in range(len(files)):
+        f = frame(index)
+        if weights["hard_mask"]:
+            w = (winner == index).astype(np.float32)
+        else:
+            w = fusion_weights(f, weights)
+        gauss = gaussian_pyramid(w[:, :, np.newaxis], levels)
+        lapl = laplacian_pyramid(f, levels)
+        if blended is None:
+            blended = [g * l for g, l in zip(gauss, lapl)]
+            weight_sum = gauss
+        else:
+            for level in range(levels):
+                blended[level] += gauss[level] * lapl[level]
+                weight_sum[level] += gauss[level]
+    for level in range(levels):
+        blended[level] /= np.maximum(weight_sum[level], WEIGHT_EPSILON)
+    return np.clip(collapse(blended), 0.0, 1.0)
+
+
+def tile_rows_for_memory(width, height, frames, memory_mb, workers=1):
+    """
+    Return the strip height for fuse_tiled() so that fusing 'frames' frames of the given
+    size with 'workers' threads stays within 'memory_mb' MB. The loaded frames take
+    FRAME_BYTES per pixel, every strip in flight needs about STRIP_BYTES per pixel and
+    frame for the weights and pyramids.
+    """
+    available = memory_mb * 1024 * 1024 - width * height * frames * FRAME_BYTES
+    rows = available / (width * frames * STRIP_BYTES * max(1, workers))
+    return int(max(2 ** pyramid_levels(height, width), rows))
+
+
+def fuse_files(files, output, weights=DEFAULT_WEIGHTS, tile_rows=TILE_ROWS, workers=0,
+               align=False):
+    """
+    Fuse the given image files and save the result to 'output', the frames are
+    aligned in memory first if 'align' is set
+    """
+    frames = load_frames(files, align, workers)
+    save_frame(fuse_tiled(frames, weights, tile_rows, workers), output)
+
+
+#########################################################################################
+# luminosity masks
+#########################################################################################
+
+# maximum difference (0..1) to neighbouring pixels which still gets blurred for the
+# blur types "Gaussian/None", "Selective/Low", "Selective/Medium", "Selective/High"
+SELECTIVE_BLUR_DELTA = [None, 50 / 255.0, 25 / 255.0, 12 / 255.0]
+TRIM_PERCENTILE      = 0.1      # percentage of mask pixels clipped on each side by auto-trim
+
+# Rec. 601 luma as used by gimp's desaturate (luminosity)
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _gaussian_kernel(radius):
+    """
+    1D gaussian kernel for a gimp blur radius, gimp uses sigma = radius / sqrt(2 ln 255)
+    """
+    sigma = max(radius, 1e-3) / math.sqrt(2.0 * math.log(255.0))
+    size = int(math.ceil(3 * sigma))
+    x = np.arange(-size, size + 1, dtype=np.float32)
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def _blur_axis(mask, kernel, axis, delta=None):
+    """
+    Convolve a 2D mask with a 1D kernel along one axis. With 'delta' only neighbours
+    which differ by at most 'delta' from the center pixel contribute (selective blur).
+    """
+    size = len(kernel) // 2
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (size, size)
+    padded = np.pad(mask, pad, mode="edge")
+    total = np.zeros_like(mask)
+    norm = np.zeros_like(mask)
+    for i, k in enumerate(kernel):
+        if axis == 0:
+            shifted = padded[i:i + mask.shape[0]]
+        else:
+            shifted = padded[:, i:i + mask.shape[1]]
+        if delta is None:
+            total += k * shifted
+        else:
+            weight = k * (np.abs(shifted - mask) <= delta)
+            total += weight * shifted
+            norm += weight
+    if delta is None:
+        return total
+    return total / norm
+
+
+def blur_mask(mask, radius, blur_type=0):
+    """
+    Blur a mask like the exposure blend script does: a gaussian blur or, for the
+    selective blur types, a separable approximation of gimp's selective gaussian blur
+    """
+    if radius <= 0:
+        return mask
+    kernel = _gaussian_kernel(radius)
+    delta = SELECTIVE_BLUR_DELTA[blur_type]
+    return _blur_axis(_blur_axis(mask, kernel, 0, delta), kernel, 1, delta)
+
+
+def stretch_mask(mask):
+    """
+    Stretch the mask histogram to the full range (gimp's levels stretch)
+    """
+    low, high = np.percentile(mask, [TRIM_PERCENTILE, 100 - TRIM_PERCENTILE])
+    if high <= low:
+        return mask
+    return np.clip((mask - low) / (high - low), 0.0, 1.0)
+
+
+def scale_frame(frame, largest_dim):
+    """
+    Scale a float RGB frame so that its largest dimension equals 'largest_dim'
+    """
+    height, width = frame.shape[:2]
+    factor = float(largest_dim) / max(height, width)
+    size = (max(1, int(round(width * factor))), max(1, int(round(height * factor))))
+    channels = [Image.fromarray(frame[:, :, c]).resize(size, Image.LANCZOS) for c in range(3)]
+    return np.dstack([np.asarray(c, dtype=np.float32) for c in channels])
+
+
+def parse_scale(value):
+    """
+    Return the largest image dimension of a "scale" setting or None if the image is not
+    scaled, empty and invalid values (the setting is free text) don't scale
+    """
+    try:
+        largest_dim = int(float(str(value).strip()))
+    except ValueError:
+        return None
+    return largest_dim if largest_dim > 0 else None
+
+
+def luminosity_blend(normal, dark, bright, settings):
+    """
+    Blend three exposures with luminosity masks, a native replacement of
+    script_fu_exposure_blend. 'settings' is a settings dict of collect_exposures.py:
+
+    - dark_mask:   grayscale source of the dark layer mask (0 dark, 1 normal, 2 bright)
+    - bright_mask: grayscale source of the inverted bright layer mask (0 bright, 1 normal, 2 dark)
+    - blur / blur_radius: blur type and radius applied to both masks
+    - trim:        stretch the mask histograms
+    - dark:        the dark layer is placed on top of the bright layer
+    - scale:       scale the largest image dimension to this value (see parse_scale())
+    """
+    largest_dim = parse_scale(settings["scale"])
+    if largest_dim:
+        normal, dark, bright = [scale_frame(f, largest_dim) for f in (normal, dark, bright)]
+    dark_source = (dark, normal, bright)[settings["dark_mask"]]
+    bright_source = (bright, normal, dark)[settings["bright_mask"]]
+    masks = {"dark": np.dot(dark_source, _LUMA),
+             "bright": 1.0 - np.dot(bright_source, _LUMA)}
+    for name, mask in masks.items():
+        if settings["trim"]:
+            mask = stretch_mask(mask)
+        masks[name] = blur_mask(mask, settings["blur_radius"], settings["blur"])[:, :, np.newaxis]
+    layers = [(bright, masks["bright"]), (dark, masks["dark"])]
+    if not settings["dark"]:
+        layers.reverse()
+    result = normal
+    for layer, mask in layers:
+        result = result * (1.0 - mask) + layer * mask
+    return np.clip(result, 0.0, 1.0)
+
+
+def luminosity_blend_files(normal, dark, bright, output, settings, align=False):
+    """
+    Blend three exposure files with luminosity masks and save the result to 'output'.
+    Runs without gimp, so it can be used in a process pool. With 'align' the dark and
+    bright frames are aligned to the normal frame in memory first.
+    """
+    frames = [load_frame(f) for f in (normal, dark, bright)]
+    if align:
+        frames = align_frames(frames, reference=0)
+    save_frame(luminosity_blend(frames[0], frames[1], frames[2], settings), output)
+
+
+#########################################################################################
+# alignment
+#########################################################################################
+#
+# Frames are aligned to the middle frame of the stack in three steps:
+#
+# 1. a translation is estimated on a pyramid of median threshold bitmaps (Ward 2003),
+#    which are independent of the exposure of a frame
+# 2. corners are detected in the reference frame on a downscaled copy, matched in
+#    the other frame by normalized cross correlation around the translated position,
+#    and a homography is fitted to the matches with RANSAC. If there are too few
+#    matches the translation is used.
+# 3. the frame is resampled once with the resulting transformation
+#
+#########################################################################################
+
+ALIGN_WORK_SIZE      = 1024     # largest dimension of the downscaled copies used for matching
+MTB_LEVELS           = 6        # pyramid levels for the translation search (+-2^levels px)
+MTB_NOISE            = 4 / 255.0 # pixels this close to the median are ignored by the bitmaps
+CORNER_GRID          = 16       # at most one corner per cell of a CORNER_GRID^2 grid
+PATCH_RADIUS         = 7        # radius of the patches which are matched
+SEARCH_RADIUS        = 8        # search radius around the translated position (work scale)
+MIN_CORRELATION      = 0.7      # minimum normalized cross correlation of a match
+RANSAC_ITERATIONS    = 500
+RANSAC_THRESHOLD     = 1.5      # maximum reprojection error of an inlier (work scale)
+MIN_INLIERS          = 12       # fall back to the translation with fewer inliers
+RESAMPLE_ROWS        = 256      # rows which are resampled at once
+
+
+def _gray(frame):
+    return np.dot(frame, _LUMA)
+
+
+def _downscale(gray, factor):
+    """
+    Downscale a 2D array by an integer factor by averaging factor x factor blocks
+    """
+    if factor <= 1:
+        return gray
+    height, width = (gray.shape[0] // factor) * factor, (gray.shape[1] // factor) * factor
+    blocks = gray[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def _overlap(shape, dx, dy):
+    """
+    Slices of two equally sized 2D arrays which overlap when the second one is
+    displaced by (dx, dy)
+    """
+    height, width = shape
+    a = (slice(max(0, dy), height + min(0, dy)), slice(max(0, dx), width + min(0, dx)))
+    b = (slice(max(0, -dy), height + min(0, -dy)), slice(max(0, -dx), width + min(0, -dx)))
+    return a, b
+
+
+def _mtb(gray):
+    median = np.median(gray)
+    return gray > median, np.abs(gray - median) > MTB_NOISE
+
+
+def mtb_translation(reference, gray, levels=MTB_LEVELS):
+    """
+    Return the translation (dx, dy) so that gray[y + dy, x + dx] matches reference[y, x]
+    """
+    levels = max(1, min(levels, int(math.log(min(reference.shape), 2)) - 4))
+    dx, dy = 0, 0
+    for level in reversed(range(levels)):
+        ref_bits, ref_valid = _mtb(_downscale(reference, 2 ** level))
+        bits, valid = _mtb(_downscale(gray, 2 ** level))
+        dx, dy = dx * 2, dy * 2
+        best = None
+        for sx in (-1, 0, 1):
+            for sy in (-1, 0, 1):
+                a, b = _overlap(bits.shape, dx + sx, dy + sy)
+                errors = ((ref_bits[b] ^ bits[a]) & ref_valid[b] & valid[a]).sum()
+                if best is None or errors < best[0]:
+                    best = (errors, dx + sx, dy + sy)
+        dx, dy = best[1], best[2]
+    return dx, dy
+
+
+def detect_corners(gray):
+    """
+    Harris corners, at most one per grid cell, returns an array of (x, y) positions
+    """
+    gy, gx = np.gradient(gray)
+    xx, yy, xy = _blur(_blur(gx * gx)), _blur(_blur(gy * gy)), _blur(_blur(gx * gy))
+    response = xx * yy - xy * xy - 0.04 * (xx + yy) ** 2
+    border = PATCH_RADIUS + SEARCH_RADIUS + 1
+    height, width = gray.shape
+    cell_h = max(1, (height - 2 * border) // CORNER_GRID)
+    cell_w = max(1, (width - 2 * border) // CORNER_GRID)
+    cells = response[border:border + cell_h * CORNER_GRID, border:border + cell_w * CORNER_GRID]
+    cells = cells.reshape(CORNER_GRID, cell_h, CORNER_GRID, cell_w).transpose(0, 2, 1, 3)
+    cells = cells.reshape(CORNER_GRID, CORNER_GRID, cell_h * cell_w)
+    best = cells.argmax(axis=2)
+    strength = cells.max(axis=2)
+    rows, cols = np.nonzero(strength > strength.max() * 0.01)
+    ys = border + rows * cell_h + best[rows, cols] // cell_w
+    xs = border + cols * cell_w + best[rows, cols] % cell_w
+    return np.column_stack((xs, ys)).astype(np.float64)
+
+
+def _normalize_patches(patches):
+    patches = patches - patches.mean(axis=(-2, -1), keepdims=True)
+    norm = np.sqrt((patches ** 2).sum(axis=(-2, -1), keepdims=True))
+    return patches / np.maximum(norm, 1e-6)
+
+
+def match_corners(reference, gray, corners, dx, dy):
+    """
+    Find the corners of 'reference' in 'gray' around the translated positions,
+    returns the matched (x, y) positions in 'reference' and in 'gray'
+    """
+    p, r = PATCH_RADIUS, SEARCH_RADIUS
+    size = 2 * p + 1
+    src, dst = [], []
+    for x, y in corners.astype(int):
+        tx, ty = x + dx, y + dy
+        if (ty - p - r < 0 or tx - p - r < 0 or
+                ty + p + r + 1 > gray.shape[0] or tx + p + r + 1 > gray.shape[1]):
+            continue
+        patch = _normalize_patches(reference[y - p:y + p + 1, x - p:x + p + 1])
+        window = gray[ty - p - r:ty + p + r + 1, tx - p - r:tx + p + r + 1]
+        strides = window.strides * 2
+        candidates = np.lib.stride_tricks.as_strided(window, (2 * r + 1, 2 * r + 1, size, size),
+                                                     strides)
+        ncc = (_normalize_patches(candidates) * patch).sum(axis=(-2, -1))
+        iy, ix = np.unravel_index(ncc.argmax(), ncc.shape)
+        if ncc[iy, ix] < MIN_CORRELATION:
+            continue
+        # sub-pixel position from a parabola through the neighbours of the maximum
+        offset = []
+        for values, i in ((ncc[iy, :], ix), (ncc[:, ix], iy)):
+            if 0 < i < 2 * r:
+                denom = values[i - 1] - 2 * values[i] + values[i + 1]
+                offset.append(i + (0.5 * (values[i - 1] - values[i + 1]) / denom if denom else 0))
+            else:
+                offset.append(i)
+        src.append((x, y))
+        dst.append((tx - r + offset[0], ty - r + offset[1]))
+    return np.array(src, dtype=np.float64), np.array(dst, dtype=np.float64)
+
+
+def _homography(src, dst):
+    """
+    Direct linear transform with Hartley normalization, maps src to dst
+    """
+    def normalization(points):
+        center = points.mean(axis=0)
+        scale = math.sqrt(2) / max(np.sqrt(((points - center) ** 2).sum(axis=1)).mean(), 1e-9)
+        return np.array([[scale, 0, -scale * center[0]], [0, scale, -scale * center[1]], [0, 0, 1]])
+    ts, td = normalization(src), normalization(dst)
+    s = np.column_stack((src, np.ones(len(src)))).dot(ts.T)
+    d = np.column_stack((dst, np.ones(len(dst)))).dot(td.T)
+    zeros = np.zeros((len(src), 3))
+    a = np.vstack((np.hstack((s, zeros, -s * d[:, 0:1])), np.hstack((zeros, s, -s * d[:, 1:2]))))
+    h = np.linalg.svd(a)[2][-1].reshape(3, 3)
+    h = np.linalg.inv(td).dot(h).dot(ts)
+    return h / h[2, 2]
+
+
+def _project(h, points):
+    p = np.column_stack((points, np.ones(len(points)))).dot(h.T)
+    return p[:, :2] / p[:, 2:3]
+
+
+def ransac_homography(src, dst, seed=0):
+    """
+    Fit a homography to the matches with RANSAC, returns (homography, inliers) or
+    (None, 0) if there aren't enough consistent matches
+    """
+    if len(src) < MIN_INLIERS:
+        return None, 0
+    random = np.random.RandomState(seed)
+    best = None
+    for i in range(RANSAC_ITERATIONS):
+        sample = random.choice(len(src), 4, replace=False)
+        try:
+            h = _homography(src[sample], dst[sample])
+            errors = np.sqrt(((_project(h, src) - dst) ** 2).sum(axis=1))
+        except (np.linalg.LinAlgError, FloatingPointError):
+            continue
+        inliers = errors < RANSAC_THRESHOLD
+        if best is None or inliers.sum() > best.sum():
+            best = inliers
+    if best is None or best.sum() < MIN_INLIERS:
+        return None, 0
+    return _homography(src[best], dst[best]), int(best.sum())
+
+
+def estimate_transform(reference, frame):
+    """
+    Return the 3x3 transformation which maps pixel positions of the reference frame
+    to positions in 'frame', both are float RGB frames of equal size
+    """
+    factor = max(1, int(math.ceil(max(reference.shape[:2]) / float(ALIGN_WORK_SIZE))))
+    ref_gray = _downscale(_gray(reference), factor)
+    gray = _downscale(_gray(frame), factor)
+    dx, dy = mtb_translation(ref_gray, gray)
+    src, dst = match_corners(ref_gray, gray, detect_corners(ref_gray), dx, dy)
+    with np.errstate(all="ignore"):
+        h, inliers = ransac_homography(src, dst)
+    if h is None:
+        h = np.array([[1.0, 0, dx], [0, 1.0, dy], [0, 0, 1.0]])
+    # from the downscaled to the full resolution coordinates
+    scale = np.array([[factor, 0, (factor - 1) / 2.0], [0, factor, (factor - 1) / 2.0], [0, 0, 1]])
+    return scale.dot(h).dot(np.linalg.inv(scale))
+
+
+def warp_frame(frame, transform):
+    """
+    Resample 'frame' so that it matches the reference frame, 'transform' maps reference
+    positions to positions in 'frame'. Bilinear interpolation, borders are repeated.
+    """
+    height, width = frame.shape[:2]
+    result = np.empty_like(frame)
+    xs = np.arange(width, dtype=np.float64)
+    for y0 in range(0, height, RESAMPLE_ROWS):
+        y1 = min(height, y0 + RESAMPLE_ROWS)
+        gx, gy = np.meshgrid(xs, np.arange(y0, y1, dtype=np.float64))
+        p = np.dot(transform, np.vstack((gx.ravel(), gy.ravel(), np.ones(gx.size))))
+        sx = np.clip(p[0] / p[2], 0, width - 1.001).reshape(gx.shape)
+        sy = np.clip(p[1] / p[2], 0, height - 1.001).reshape(gx.shape)
+        ix, iy = sx.astype(np.intp), sy.astype(np.intp)
+        fx = (sx - ix).astype(np.float32)[:, :, np.newaxis]
+        fy = (sy - iy).astype(np.float32)[:, :, np.newaxis]
+        top = frame[iy, ix] * (1 - fx) + frame[iy, ix + 1] * fx
+        bottom = frame[iy + 1, ix] * (1 - fx) + frame[iy + 1, ix + 1] * fx
+        result[y0:y1] = top * (1 - fy) + bottom * fy
+    return result
+
+
+def align_frames(frames, workers=0, reference=None):
+    """
+    Align all frames of a stack to the frame with index 'reference' (default: the
+    middle frame), the frames are processed in parallel by a pool of worker threads.
+    Returns the list of aligned frames.
+    """
+    reference = frames[len(frames) // 2 if reference is None else reference]
+
+    def align_frame(frame):
+        if frame is reference:
+            return frame
+        return warp_frame(frame, estimate_transform(reference, frame))
+
+    pool = ThreadPool(max(1, min(len(frames), workers or multiprocessing.cpu_count())))
+    try:
+        return pool.map(align_frame, frames)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def align_files(files, outputs, workers=0):
+    """
+    Align image files to the middle file and save the aligned frames to 'outputs', the
+    EXIF data of the JPG sources is copied over. Outputs with PLANES_EXTENSION are planar
+    intermediates. Only the reference frame and the frames of the 'workers' threads
+    are in memory, every frame is saved as soon as it is aligned.
+    """
+    middle = len(files) // 2
+    reference = load_frame(files[middle])
+
+    def align_file(index):
+        if index == middle:
+            frame = reference
+        else:
+            frame = load_frame(files[index])
+            frame = warp_frame(frame, estimate_transform(reference, frame))
+        save_aligned(frame, files[index], outputs[index])
+
+    pool = ThreadPool(max(1, min(len(files), workers or multiprocessing.cpu_count())))
+    try:
+        pool.map(align_file, range(len(files)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def save_aligned(frame, source, output):
+    """
+    Save an aligned frame of the file 'source' to 'output' (see align_files())
+    """
+    if is_planes(output):
+        save_planes(frame, output)
+        return
+    exif = None if is_native_format(source) else Image.open(source).info.get("exif")
+    data = np.clip(frame * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    options = {}
+    if output.upper().endswith(("JPG", "JPEG")):
+        options = {"quality": 100, "subsampling": 0}
+        if exif:
+            options["exif"] = exif
+    Image.fromarray(data, "RGB").save(output, **options)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Description: Crops and exports all passport photos of a directory without gimp:
+#
+#                 python passport_batch.py input_directory output_directory
+#
+#              The eyes and the chin of every photo are read from a sidecar file next
+#              to it (IMG_0001.jpg -> IMG_0001.json, pixel coordinates from the top left):
+#
+#                 {"left_eye": [x, y], "right_eye": [x, y], "chin": [x, y]}
+#
+#              Photos without sidecar file are searched for the face with the cascades
+#              of passport_detect.py if OpenCV is installed, every worker process loads
+#              them once.
+#
+#              The crop puts them on the lines of passport_geometry.py (the same ratios
+#              as the guides of passport_rulers.py), the photos are exported as JPG of
+#              35x45mm at EXPORT_DPI. The photos are processed by a pool of PROCESSES.
+#
+
+from PIL import Image
+import passport_geometry as geometry
+import passport_detect
+import multiprocessing
+import json
+import math
+import os
+import sys
+
+FILE_FORMATS     = ["JPG", "JPEG", "TIF", "TIFF", "PNG"]
+SIDECAR_EXTENSION = ".json"
+EXPORT_DPI       = geometry.EXPORT_DPI
+JPEG_QUALITY     = 95
+BACKGROUND       = (255, 255, 255) # fills the parts of the crop outside the photo
+PROCESSES        = 0            # 0 means one per CPU core
+
+
+def load_sidecar(filename):
+    """
+    Return the landmarks of the sidecar file of the photo 'filename' or None if there
+    is no sidecar file
+    """
+    sidecar = filename.rsplit(".", 1)[0] + SIDECAR_EXTENSION
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as f:
+        return json.load(f)
+
+
+def landmarks(filename):
+    """
+    Return (eye_x, eye_y, chin_y) of the photo 'filename' or None if they are unknown
+    """
+    marks = load_sidecar(filename)
+    if marks is None and passport_detect.cv2:
+        marks = passport_detect.detect_file(filename)
+    return marks and passport_detect.eye_chin(marks)
+
+
+def crop_photo(im, left, top, width, height, size):
+    """
+    Crop the rectangle (left, top, width, height) out of the image 'im' and scale it to
+    'size', parts outside of the image are filled with BACKGROUND
+    """
+    box = [int(round(v)) for v in (left, top, left + width, top + height)]
+    canvas = Image.new("RGB", (box[2] - box[0], box[3] - box[1]), BACKGROUND)
+    inside = (max(0, box[0]), max(0, box[1]), min(im.size[0], box[2]), min(im.size[1], box[3]))
+    if inside[0] < inside[2] and inside[1] < inside[3]:
+        canvas.paste(im.crop(inside), (inside[0] - box[0], inside[1] - box[1]))
+    return canvas.resize(size, Image.LANCZOS)
+
+
+def export_photo(filename, output, dpi=EXPORT_DPI, quality=JPEG_QUALITY):
+    """
+    Crop the passport photo 'filename' and save it to 'output', returns an error
+    message or None
+    """
+    marks = landmarks(filename)
+    if marks is None:
+        return "no eye and chin positions found"
+    im = Image.open(filename)
+    left, top, width, height = geometry.crop_rectangle(*marks)
+    size = geometry.export_size(dpi)
+    # JPEGs are decoded at the smallest DCT scale which still covers the export size
+    scale = size[1] / height
+    if scale < 1:
+        original = im.size[0]
+        im.draft("RGB", (int(math.ceil(im.size[0] * scale)), int(math.ceil(im.size[1] * scale))))
+        factor = float(im.size[0]) / original
+        left, top, width, height = left * factor, top * factor, width * factor, height * factor
+    photo = crop_photo(im.convert("RGB"), left, top, width, height, size)
+    photo.save(output, "JPEG", quality=quality, subsampling=0, dpi=(dpi, dpi))
+    return None
+
+
+def _export_job(job):
+    filename, output = job
+    try:
+        return filename, export_photo(filename, output)
+    except Exception as error:
+        return filename, str(error)
+
+
+def batch_jobs(directory, output_directory):
+    for name in sorted(os.listdir(directory)):
+        if name.rsplit(".", 1)[-1].upper() in FILE_FORMATS:
+            yield (os.path.join(directory, name),
+                   os.path.join(output_directory, name.rsplit(".", 1)[0] + ".jpg"))
+
+
+def export_directory(directory, output_directory, processes=PROCESSES):
+    """
+    Crop and export all photos of 'directory', returns the photos which failed
+    """
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    failed = []
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        for filename, error in pool.imap_unordered(_export_job,
+                                                   batch_jobs(directory, output_directory)):
+            if error:
+                print "%s: %s" % (filename, error)
+                failed.append(filename)
+            else:
+                print "exported %s" % filename
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "usage: %s input_directory output_directory" % sys.argv[0]
+        sys.exit(1)
+    failed = export_directory(sys.argv[1], sys.argv[2])
+    if failed:
+        print "%d photos failed" % len(failed)
+        sys.exit(1)
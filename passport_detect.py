@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Description: Finds the eyes and the chin in portraits with the Haar cascades which
+#              come with OpenCV (CPU only, no downloads), so passport photos can be
+#              cropped without manually placed guides or sidecar files:
+#
+#                 python passport_detect.py photo.jpg ...
+#
+#              prints the landmarks, the crop rectangle and the guide positions of
+#              passport_rulers.py (in the coordinates of the photo) as JSON.
+#
+#              The detection runs on a grayscale copy downscaled to DETECT_SIZE pixels
+#              on its longer edge. The cascades are loaded once per process (see
+#              detector()), batch workers reuse them for all their photos.
+#
+#              The cascades find the eyes, the chin is estimated from the face box:
+#              the box of the frontal face cascade ends between mouth and chin, the
+#              chin is at CHIN_FACTOR of its height. Without two eyes in the upper half
+#              of the face the eye line is at EYE_FACTOR of the face box.
+#
+
+import passport_geometry as geometry
+import numpy as np
+import json
+import sys
+
+# OpenCV is optional, without it photos need sidecar files
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+DETECT_SIZE      = 640          # longer edge of the copy the detection runs on
+CASCADE_DIR      = ""           # empty means the cascades of the OpenCV installation
+FACE_CASCADE     = "haarcascade_frontalface_default.xml"
+EYE_CASCADE      = "haarcascade_eye.xml"
+MIN_FACE         = 0.15         # minimum face size relative to the shorter edge
+EYE_FACTOR       = 0.4          # eye line relative to the face box, if no eyes are found
+CHIN_FACTOR      = 1.08         # chin relative to the face box
+
+
+class Detector(object):
+    """
+    Face and eye cascades, loading them takes longer than detecting a face
+    """
+    def __init__(self, cascade_dir=CASCADE_DIR):
+        if cv2 is None:
+            raise ImportError("OpenCV (cv2) is needed to detect faces")
+        directory = cascade_dir or cv2.data.haarcascades
+        self.faces = cv2.CascadeClassifier(directory + "/" + FACE_CASCADE)
+        self.eyes = cv2.CascadeClassifier(directory + "/" + EYE_CASCADE)
+        if self.faces.empty() or self.eyes.empty():
+            raise IOError("can't load the cascades from %s" % directory)
+
+    def detect(self, gray, scale=1.0):
+        """
+        Return the landmarks {"left_eye": [x, y], "right_eye": [x, y], "chin": [x, y]}
+        in the grayscale uint8 array 'gray' or None if there is no face. The positions
+        are divided by 'scale', the factor 'gray' was downscaled with.
+        """
+        height, width = gray.shape
+        minimum = int(min(width, height) * MIN_FACE)
+        faces, hits = self.faces.detectMultiScale2(gray, 1.1, 5, minSize=(minimum, minimum))
+        if len(faces) == 0:
+            return None
+        # the face with the most overlapping detections, false positives have few
+        x, y, w, h = faces[int(np.argmax(hits))]
+        # eyes in the upper half of the face, the two largest ones
+        upper = gray[y:y + h // 2, x:x + w]
+        eyes = self.eyes.detectMultiScale(upper, 1.1, 3, minSize=(w // 10, w // 10))
+        eyes = sorted(eyes, key=lambda e: e[2] * e[3])[-2:]
+        if len(eyes) == 2 and abs(eyes[0][0] - eyes[1][0]) > w // 5:
+            centers = sorted((x + ex + ew / 2.0, y + ey + eh / 2.0) for ex, ey, ew, eh in eyes)
+        else:
+            eye_y = y + h * EYE_FACTOR
+            centers = [(x + w * 0.3, eye_y), (x + w * 0.7, eye_y)]
+        chin = (x + w / 2.0, y + h * CHIN_FACTOR)
+        # the left eye of the person is on the right side of the photo
+        return {"left_eye":  [v / scale for v in centers[1]],
+                "right_eye": [v / scale for v in centers[0]],
+                "chin":      [v / scale for v in chin]}
+
+
+# the detector of this process
+_detector = None
+
+
+def detector():
+    global _detector
+    if _detector is None:
+        _detector = Detector()
+    return _detector
+
+
+def downscale(image):
+    """
+    Return a grayscale copy of the RGB(A) or grayscale uint8 array 'image' with at most
+    DETECT_SIZE pixels on its longer edge and the factor it was scaled with
+    """
+    if image.ndim == 3:
+        channels = image.shape[2]
+        if channels in (3, 4):
+            image = cv2.cvtColor(np.ascontiguousarray(image[:, :, :3]), cv2.COLOR_RGB2GRAY)
+        else:
+            image = image[:, :, 0]
+    scale = min(1.0, float(DETECT_SIZE) / max(image.shape))
+    if scale < 1.0:
+        size = (int(round(image.shape[1] * scale)), int(round(image.shape[0] * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return np.ascontiguousarray(image), scale
+
+
+def detect(image):
+    """
+    Return the landmarks (see Detector.detect()) of the photo in the uint8 array
+    'image' or None
+    """
+    gray, scale = downscale(image)
+    return detector().detect(gray, scale)
+
+
+def detect_file(filename):
+    """
+    Return the landmarks of the photo 'filename' or None, JPEGs are decoded at
+    reduced size
+    """
+    from PIL import Image # not needed for arrays, e.g. in gimp
+    im = Image.open(filename)
+    width, height = im.size
+    scale = min(1.0, float(DETECT_SIZE) / max(width, height))
+    im.draft("L", (int(width * scale) + 1, int(height * scale) + 1))
+    gray = np.asarray(im.convert("L"))
+    landmarks = detect(gray)
+    if landmarks and im.size[0] != width:
+        # positions relative to the draft, not to the photo
+        factor = float(width) / im.size[0]
+        landmarks = dict((k, [v * factor for v in p]) for k, p in landmarks.items())
+    return landmarks
+
+
+def eye_chin(landmarks):
+    """
+    Return (eye_x, eye_y, chin_y) of the landmarks, the arguments of
+    passport_geometry.crop_rectangle()
+    """
+    (lx, ly), (rx, ry) = landmarks["left_eye"], landmarks["right_eye"]
+    return (lx + rx) / 2.0, (ly + ry) / 2.0, float(landmarks["chin"][1])
+
+
+def guides(landmarks):
+    """
+    Return the crop rectangle and the guides of passport_rulers.py for the landmarks
+    of a photo, in the coordinates of the photo
+    """
+    left, top, width, height = geometry.crop_rectangle(*eye_chin(landmarks))
+    horizontal, vertical = geometry.eye_guides(width, height)
+    horizontal += geometry.face_guides(width, height)
+    return {"crop":       [left, top, width, height],
+            "horizontal": [top + h for h in horizontal],
+            "vertical":   [left + v for v in vertical]}
+
+
+if __name__ == "__main__":
+    results = {}
+    for filename in sys.argv[1:]:
+        landmarks = detect_file(filename)
+        results[filename] = landmarks and dict(guides(landmarks), landmarks=landmarks)
+    print json.dumps(results, indent=4, sort_keys=True)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Description: Geometry of portraits according to the german / european passport
+#              standard, shared by passport_rulers.py and the batch tools. All ratios
+#              are fractions of the cropped photo: heights are measured from the bottom
+#              edge, widths from the left edge.
+#              References:
+#              - https://www.bundesdruckerei.de/sites/default/files/fotomustertafel_72dpi.pdf
+#              - https://www.bundesdruckerei.de/sites/default/files/passbildschablone_erwachsene.pdf
+#
+
+# step 1: eyes and nose
+EYES_TOP         = 0.71         # the eyes have to be between these lines
+EYES_BOTTOM      = 0.487
+NOSE_LEFT        = 0.444        # the nose has to be between these lines
+NOSE_RIGHT       = 0.556
+
+# step 2: face
+FACE_OPT_TOP     = 0.948        # the top of the head is optimal between these lines
+FACE_OPT_BOTTOM  = 0.86
+FACE_BOTTOM      = 0.75         # lowest top of the head
+CHIN             = 0.137
+
+# size of the photo
+PHOTO_WIDTH_MM   = 35.0
+PHOTO_HEIGHT_MM  = 45.0
+EXPORT_DPI       = 600
+
+
+def eye_guides(width, height):
+    """
+    Return the horizontal and vertical guides of step 1 for an image of width x height
+    """
+    return ([height * (1 - EYES_TOP), height * (1 - EYES_BOTTOM)],
+            [width * NOSE_LEFT, width * NOSE_RIGHT])
+
+
+def face_guides(width, height):
+    """
+    Return the horizontal guides of step 2 for an image of width x height
+    """
+    return [height * (1 - FACE_OPT_BOTTOM), height * (1 - FACE_OPT_TOP),
+            height * (1 - FACE_BOTTOM), height * (1 - CHIN)]
+
+
+def eye_line():
+    # target height of the eye line: the middle of the eye band
+    return (EYES_TOP + EYES_BOTTOM) / 2.0
+
+
+def crop_rectangle(eye_x, eye_y, chin_y):
+    """
+    Return the crop (left, top, width, height) which puts the eye line at the middle of
+    the eye band, the chin on the chin line and the point between the eyes (eye_x,
+    eye_y) in the middle of the nose band. Coordinates are pixels from the top left.
+    """
+    if chin_y <= eye_y:
+        raise ValueError("the chin (%s) has to be below the eyes (%s)" % (chin_y, eye_y))
+    height = (chin_y - eye_y) / (eye_line() - CHIN)
+    width = height * PHOTO_WIDTH_MM / PHOTO_HEIGHT_MM
+    top = eye_y - height * (1 - eye_line())
+    left = eye_x - width * (NOSE_LEFT + NOSE_RIGHT) / 2.0
+    return left, top, width, height
+
+
+def export_size(dpi=EXPORT_DPI):
+    """
+    Return the size (width, height) in pixels of the photo at 'dpi'
+    """
+    return (int(round(PHOTO_WIDTH_MM / 25.4 * dpi)),
+            int(round(PHOTO_HEIGHT_MM / 25.4 * dpi)))
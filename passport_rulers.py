@@ -7,10 +7,13 @@
 #              - https://www.bundesdruckerei.de/sites/default/files/fotomustertafel_72dpi.pdf
 #              - https://www.bundesdruckerei.de/sites/default/files/passbildschablone_erwachsene.pdf
 #
+#              The ratios are defined in passport_geometry.py.
+#
 # Author: Philipp Lutz (philipp.lutz@gmx.de)
 #
 
 from gimpfu import *
+import passport_geometry
 import math
 
 
@@ -19,11 +22,8 @@ def passport_rulers1(timg, tdrawable):
         width = tdrawable.width
         height = tdrawable.height
         
-        height_eyes_top = height * (1 - 0.71)
-        height_eyes_bottom = height * (1 - 0.487)
-
-        width_nose_left = width * 0.444
-        width_nose_right = width * 0.556
+        (height_eyes_top, height_eyes_bottom), (width_nose_left, width_nose_right) = \
+                passport_geometry.eye_guides(width, height)
 
         pdb.gimp_image_undo_group_start(timg)
         pdb.gimp_image_add_hguide(timg, height_eyes_top)
@@ -37,11 +37,8 @@ def passport_rulers2(timg, tdrawable):
         width = tdrawable.width
         height = tdrawable.height
         
-        height_face_opt_top = height * (1 - 0.948)
-        height_face_opt_bottom = height * (1 - 0.86)
-        height_face_bottom = height * (1 - 0.75)
-        
-        height_chin = height * (1 - 0.137)
+        height_face_opt_bottom, height_face_opt_top, height_face_bottom, height_chin = \
+                passport_geometry.face_guides(width, height)
 
         pdb.gimp_image_undo_group_start(timg)
         pdb.gimp_image_add_hguide(timg, height_face_opt_bottom)
@@ -50,6 +47,39 @@ def passport_rulers2(timg, tdrawable):
         pdb.gimp_image_add_hguide(timg, height_chin)
         pdb.gimp_image_undo_group_end(timg)
 
+def passport_rulers_auto(timg, tdrawable):
+        # needs numpy and OpenCV, which are not part of every gimp installation
+        try:
+                import numpy
+                import passport_detect
+                if passport_detect.cv2 is None:
+                        raise ImportError("No module named cv2")
+        except ImportError as error:
+                pdb.gimp_message("Passport Rulers - Auto: %s" % error)
+                return
+        width = tdrawable.width
+        height = tdrawable.height
+
+        region = tdrawable.get_pixel_rgn(0, 0, width, height, False, False)
+        pixels = numpy.frombuffer(region[0:width, 0:height], numpy.uint8)
+        landmarks = passport_detect.detect(pixels.reshape(height, width, tdrawable.bpp))
+        if landmarks is None:
+                pdb.gimp_message("Passport Rulers - Auto: no face found")
+                return
+        guides = passport_detect.guides(landmarks)
+
+        pdb.gimp_image_undo_group_start(timg)
+        for position in guides["horizontal"]:
+                if 0 <= position <= height:
+                        pdb.gimp_image_add_hguide(timg, int(round(position)))
+        for position in guides["vertical"]:
+                if 0 <= position <= width:
+                        pdb.gimp_image_add_vguide(timg, int(round(position)))
+        # select the crop, Image > Crop to Selection finishes the photo
+        left, top, crop_width, crop_height = guides["crop"]
+        pdb.gimp_image_select_rectangle(timg, CHANNEL_OP_REPLACE, left, top, crop_width, crop_height)
+        pdb.gimp_image_undo_group_end(timg)
+
 
 register(
         "python_fu_passport_rulers1",
@@ -77,4 +107,17 @@ register(
         [],
         passport_rulers2)
 
+register(
+        "python_fu_passport_rulers_auto",
+        "Passport Rulers - Auto",
+        "Passport Rulers - Auto",
+        "Philipp Lutz",
+        "Philipp Lutz",
+        "2010-2011",
+        "<Image>/Filters/Misc/Passport Rulers - Auto",
+        "RGB*, GRAY*",
+        [],
+        [],
+        passport_rulers_auto)
+
 main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Description: Lays out cropped passport photos (e.g. the exports of passport_batch.py)
+#              on print sheets of SHEET_WIDTH_MM x SHEET_HEIGHT_MM with cut marks:
+#
+#                 python passport_sheet.py input_directory output_directory [copies]
+#
+#              Every photo is printed 'copies' times (COPIES by default), a sheet holds
+#              as many photos as fit with all their copies, e.g. one photo with 8
+#              copies or two photos with 4 copies on 10x15cm. The photos are placed in
+#              a grid with GAP_MM between them which is centered on the sheet, the
+#              sheet is turned if more photos fit on it that way. The cut marks are
+#              drawn in the margins along the edges of the photos.
+#
+#              The sheets are rendered at SHEET_DPI by a pool of PROCESSES and saved
+#              as sheet_0001.jpg, ... by the process which rendered them, so only one
+#              sheet per process is in memory.
+#
+
+from PIL import Image, ImageDraw
+import passport_geometry as geometry
+import passport_batch
+import multiprocessing
+import os
+import sys
+
+SHEET_WIDTH_MM   = 150.0
+SHEET_HEIGHT_MM  = 100.0
+SHEET_DPI        = geometry.EXPORT_DPI
+COPIES           = 0            # 0 means as many as fit on a sheet
+GAP_MM           = 2.0          # space between the photos
+CUT_MARK_MM      = 0.5          # distance of the cut marks to the photos
+CUT_MARK_WIDTH   = 0.2          # line width of the cut marks in mm
+JPEG_QUALITY     = 95
+PROCESSES        = 0            # 0 means one per CPU core
+
+
+def mm_to_pixels(mm, dpi):
+    return int(round(mm / 25.4 * dpi))
+
+
+def sheet_layout(sheet=(SHEET_WIDTH_MM, SHEET_HEIGHT_MM), gap=GAP_MM):
+    """
+    Return the size (width, height) of the sheet in mm, turned if more photos fit on it
+    that way, and the number of columns and rows of photos
+    """
+    layouts = []
+    for width, height in (sheet, sheet[::-1]):
+        columns = int((width + gap) // (geometry.PHOTO_WIDTH_MM + gap))
+        rows = int((height + gap) // (geometry.PHOTO_HEIGHT_MM + gap))
+        layouts.append((columns * rows, (width, height), columns, rows))
+    count, size, columns, rows = max(layouts)
+    if count == 0:
+        raise ValueError("no photo fits on a sheet of %sx%smm" % sheet)
+    return size, columns, rows
+
+
+def photo_positions(count, size, columns, gap=GAP_MM):
+    """
+    Return the top left corners in mm of 'count' photos on a sheet of 'size' mm with
+    'columns' columns, the used part of the grid is centered
+    """
+    used_columns = min(count, columns)
+    used_rows = (count + columns - 1) // columns
+    left = (size[0] - used_columns * (geometry.PHOTO_WIDTH_MM + gap) + gap) / 2.0
+    top = (size[1] - used_rows * (geometry.PHOTO_HEIGHT_MM + gap) + gap) / 2.0
+    return [(left + (i % columns) * (geometry.PHOTO_WIDTH_MM + gap),
+             top + (i // columns) * (geometry.PHOTO_HEIGHT_MM + gap)) for i in range(count)]
+
+
+def draw_cut_marks(sheet, boxes, dpi):
+    """
+    Draw the cut marks of the photo 'boxes' (left, top, right, bottom in pixels) in the
+    margins of the sheet
+    """
+    draw = ImageDraw.Draw(sheet)
+    width = max(1, mm_to_pixels(CUT_MARK_WIDTH, dpi))
+    offset = mm_to_pixels(CUT_MARK_MM, dpi)
+    left = min(b[0] for b in boxes) - offset
+    top = min(b[1] for b in boxes) - offset
+    right = max(b[2] for b in boxes) + offset
+    bottom = max(b[3] for b in boxes) + offset
+    for x in set(x for b in boxes for x in (b[0], b[2])):
+        draw.line([(x, 0), (x, top)], fill=0, width=width)
+        draw.line([(x, bottom), (x, sheet.size[1])], fill=0, width=width)
+    for y in set(y for b in boxes for y in (b[1], b[3])):
+        draw.line([(0, y), (left, y)], fill=0, width=width)
+        draw.line([(right, y), (sheet.size[0], y)], fill=0, width=width)
+
+
+def render_sheet(filenames, copies, output, dpi=SHEET_DPI, quality=JPEG_QUALITY):
+    """
+    Render 'copies' of every photo of 'filenames' on a sheet and save it to 'output'
+    """
+    size, columns, rows = sheet_layout()
+    photo_size = geometry.export_size(dpi)
+    positions = photo_positions(len(filenames) * copies, size, columns)
+    sheet = Image.new("RGB", (mm_to_pixels(size[0], dpi), mm_to_pixels(size[1], dpi)),
+                      (255, 255, 255))
+    boxes = []
+    for i, filename in enumerate(filenames):
+        im = Image.open(filename)
+        im.draft("RGB", photo_size)
+        photo = im.convert("RGB")
+        if photo.size != photo_size:
+            photo = photo.resize(photo_size, Image.LANCZOS)
+        for x, y in positions[i * copies:(i + 1) * copies]:
+            box = (mm_to_pixels(x, dpi), mm_to_pixels(y, dpi))
+            sheet.paste(photo, box)
+            boxes.append(box + (box[0] + photo_size[0], box[1] + photo_size[1]))
+        del photo, im
+    draw_cut_marks(sheet, boxes, dpi)
+    sheet.save(output, "JPEG", quality=quality, subsampling=0, dpi=(dpi, dpi))
+
+
+def _render_job(job):
+    filenames, copies, output = job
+    try:
+        render_sheet(filenames, copies, output)
+        return output, None
+    except Exception as error:
+        return output, str(error)
+
+
+def sheet_jobs(filenames, output_directory, copies=COPIES):
+    """
+    Return (photos, copies, output file) for the sheets of all photos of 'filenames'
+    """
+    size, columns, rows = sheet_layout()
+    copies = copies or columns * rows
+    per_sheet = columns * rows // copies
+    if per_sheet == 0:
+        raise ValueError("%d copies don't fit on a sheet, at most %d" % (copies, columns * rows))
+    return [(filenames[i:i + per_sheet], copies,
+             os.path.join(output_directory, "sheet_%04d.jpg" % (i // per_sheet + 1)))
+            for i in range(0, len(filenames), per_sheet)]
+
+
+def render_directory(directory, output_directory, copies=COPIES, processes=PROCESSES):
+    """
+    Render the sheets of all photos of 'directory', returns the sheets which failed
+    """
+    filenames = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                 if name.rsplit(".", 1)[-1].upper() in passport_batch.FILE_FORMATS]
+    jobs = sheet_jobs(filenames, output_directory, copies)
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    failed = []
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        for output, error in pool.imap_unordered(_render_job, jobs):
+            if error:
+                print "%s: %s" % (output, error)
+                failed.append(output)
+            else:
+                print "rendered %s" % output
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print "usage: %s input_directory output_directory [copies]" % sys.argv[0]
+        sys.exit(1)
+    copies = int(sys.argv[3]) if len(sys.argv) == 4 else COPIES
+    try:
+        failed = render_directory(sys.argv[1], sys.argv[2], copies)
+    except ValueError as error:
+        print error
+        sys.exit(1)
+    if failed:
+        print "%d sheets failed" % len(failed)
+        sys.exit(1)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Description: Checks cropped passport photos (e.g. the exports of passport_batch.py)
+#              against the lines of passport_geometry.py, so rejects are caught before
+#              printing:
+#
+#                 python passport_validate.py photo.jpg directory ...
+#
+#              prints one JSON object per photo and line as soon as it is checked:
+#
+#                 {"file": STRING, "pass": BOOL, "checks": {...}, "measurements": {...}}
+#
+#              checks:
+#              - aspect:     the photo has the aspect ratio of 35x45mm
+#              - background: the background above and beside the head is light and even
+#              - head_top:   the top of the head is between FACE_BOTTOM and the top edge
+#              - head_height: the height from the chin to the top of the head is between
+#                            FACE_BOTTOM - CHIN and FACE_OPT_TOP - CHIN
+#              - eye_line:   the eyes are between EYES_BOTTOM and EYES_TOP
+#              - centered:   the point between the eyes is between NOSE_LEFT and NOSE_RIGHT
+#              - exposure:   the face is neither too dark nor too bright nor clipped
+#
+#              The eyes and the chin are read from a sidecar file (see passport_batch.py)
+#              or detected with passport_detect.py, without both these checks are null
+#              and don't fail the photo. Heights are fractions of the photo from the
+#              bottom edge like in passport_geometry.py.
+#
+#              The metrics are computed with NumPy on a copy of VALIDATE_HEIGHT pixels
+#              (JPEGs are decoded at reduced size), the photos are checked by a pool of
+#              PROCESSES. The exit code is 1 if any photo failed.
+#
+
+from PIL import Image
+import passport_geometry as geometry
+import passport_detect
+import passport_batch
+import numpy as np
+import multiprocessing
+import json
+import os
+import sys
+
+VALIDATE_HEIGHT      = 360          # height of the copy the metrics are computed on
+ASPECT_TOLERANCE     = 0.01
+BACKGROUND_STRIP     = 0.04         # top rows which are background in a valid photo
+BACKGROUND_SIDE      = 0.08         # columns left and right of the head
+BACKGROUND_MIN_LUMA  = 150.0        # light background
+BACKGROUND_MAX_STD   = 12.0         # even background
+HEAD_DISTANCE        = 40.0         # minimum difference of a head pixel to the background
+HEAD_COVERAGE        = 0.1          # part of the middle columns the head has to cover
+EXPOSURE_MIN_LUMA    = 70.0         # mean brightness of the face
+EXPOSURE_MAX_LUMA    = 200.0
+CLIPPED_MAX          = 0.02         # part of the face which may be black or white
+PROCESSES            = 0            # 0 means one per CPU core
+CHUNK_SIZE           = 8            # photos sent to a process at once
+
+LUMA = np.array([0.299, 0.587, 0.114], np.float32)
+
+
+def load_photo(filename):
+    """
+    Return the photo 'filename' as RGB uint8 array of VALIDATE_HEIGHT pixels height and
+    the size of the photo
+    """
+    im = Image.open(filename)
+    size = im.size
+    width = max(1, int(round(size[0] * float(VALIDATE_HEIGHT) / size[1])))
+    im.draft("RGB", (width, VALIDATE_HEIGHT))
+    im = im.convert("RGB")
+    if im.size != (width, VALIDATE_HEIGHT):
+        im = im.resize((width, VALIDATE_HEIGHT), Image.BILINEAR)
+    return np.asarray(im), size
+
+
+def measure_background(rgb):
+    """
+    Return the color, the brightness and the standard deviation of the brightness of the
+    background above and beside the head
+    """
+    height, width = rgb.shape[:2]
+    strip = max(1, int(height * BACKGROUND_STRIP))
+    side = max(1, int(width * BACKGROUND_SIDE))
+    samples = np.concatenate([rgb[:strip].reshape(-1, 3),
+                              rgb[strip:height // 2, :side].reshape(-1, 3),
+                              rgb[strip:height // 2, -side:].reshape(-1, 3)]).astype(np.float32)
+    luma = samples.dot(LUMA)
+    return np.median(samples, axis=0), float(luma.mean()), float(luma.std())
+
+
+def find_head_top(rgb, background):
+    """
+    Return the first row in which the head covers HEAD_COVERAGE of the middle columns or
+    None if there is no such row
+    """
+    width = rgb.shape[1]
+    middle = rgb[:, width // 4:width * 3 // 4].astype(np.float32)
+    distance = np.abs(middle - background).max(axis=2)
+    rows = np.flatnonzero((distance > HEAD_DISTANCE).mean(axis=1) > HEAD_COVERAGE)
+    return int(rows[0]) if len(rows) else None
+
+
+def face_region(rgb, marks):
+    """
+    Return the pixels of the face between the eye line and the chin, the middle of the
+    photo if the landmarks are unknown
+    """
+    height, width = rgb.shape[:2]
+    if marks is None:
+        return rgb[int(height * 0.35):int(height * 0.65), int(width * 0.35):int(width * 0.65)]
+    eye_x, eye_y, chin_y = marks
+    half = (chin_y - eye_y) / 2.0
+    top, bottom = int(max(0, eye_y)), int(min(height, chin_y))
+    left, right = int(max(0, eye_x - half)), int(min(width, eye_x + half))
+    return rgb[top:max(bottom, top + 1), left:max(right, left + 1)]
+
+
+def photo_landmarks(filename, rgb, size):
+    """
+    Return (eye_x, eye_y, chin_y) in the coordinates of 'rgb', None if no face was
+    found and False if the landmarks are unknown
+    """
+    marks = passport_batch.load_sidecar(filename)
+    if marks is not None:
+        factor = float(rgb.shape[0]) / size[1]
+        return tuple(v * factor for v in passport_detect.eye_chin(marks))
+    if passport_detect.cv2 is None:
+        return False
+    marks = passport_detect.detect(rgb)
+    return marks and passport_detect.eye_chin(marks)
+
+
+def validate(rgb, size, marks):
+    """
+    Return the checks and the measurements of the photo 'rgb' (original 'size') with the
+    landmarks 'marks' (see photo_landmarks())
+    """
+    height, width = rgb.shape[:2]
+    checks = {}
+    measurements = {}
+
+    aspect = float(size[0]) / size[1]
+    measurements["aspect"] = aspect
+    checks["aspect"] = abs(aspect - geometry.PHOTO_WIDTH_MM / geometry.PHOTO_HEIGHT_MM) \
+        <= ASPECT_TOLERANCE
+
+    background, luma, spread = measure_background(rgb)
+    measurements["background"] = luma
+    measurements["background_std"] = spread
+    checks["background"] = luma >= BACKGROUND_MIN_LUMA and spread <= BACKGROUND_MAX_STD
+
+    row = find_head_top(rgb, background)
+    head_top = None if row is None else 1 - float(row) / height
+    measurements["head_top"] = head_top
+    measurements["head_top_optimal"] = head_top is not None and \
+        geometry.FACE_OPT_BOTTOM <= head_top <= geometry.FACE_OPT_TOP
+    # a head which touches the top edge is cut off
+    checks["head_top"] = bool(row) and head_top >= geometry.FACE_BOTTOM
+
+    if marks is False:
+        for name in ("head_height", "eye_line", "centered"):
+            measurements[name] = checks[name] = None
+    elif marks is None:
+        for name in ("head_height", "eye_line", "centered"):
+            measurements[name] = None
+            checks[name] = False
+    else:
+        eye_x, eye_y, chin_y = marks
+        eye_line = 1 - eye_y / height
+        center = eye_x / width
+        measurements["eye_line"] = eye_line
+        measurements["centered"] = center
+        checks["eye_line"] = geometry.EYES_BOTTOM <= eye_line <= geometry.EYES_TOP
+        checks["centered"] = geometry.NOSE_LEFT <= center <= geometry.NOSE_RIGHT
+        if row is None:
+            measurements["head_height"] = None
+            checks["head_height"] = False
+        else:
+            head_height = (chin_y - row) / height
+            measurements["head_height"] = head_height
+            checks["head_height"] = geometry.FACE_BOTTOM - geometry.CHIN <= head_height \
+                <= geometry.FACE_OPT_TOP - geometry.CHIN
+
+    face = face_region(rgb, marks or None).reshape(-1, 3).astype(np.float32).dot(LUMA)
+    exposure = float(face.mean())
+    clipped = float(np.count_nonzero((face <= 5) | (face >= 250))) / face.size
+    measurements["exposure"] = exposure
+    measurements["clipped"] = clipped
+    checks["exposure"] = EXPOSURE_MIN_LUMA <= exposure <= EXPOSURE_MAX_LUMA \
+        and clipped <= CLIPPED_MAX
+
+    # NumPy scalars to plain values for JSON
+    for name, value in checks.items():
+        checks[name] = None if value is None else bool(value)
+    for name, value in measurements.items():
+        if isinstance(value, (float, np.floating)):
+            measurements[name] = round(float(value), 4)
+        elif isinstance(value, np.bool_):
+            measurements[name] = bool(value)
+    return checks, measurements
+
+
+def validate_file(filename):
+    """
+    Return the result of the photo 'filename' (see the description at the top)
+    """
+    rgb, size = load_photo(filename)
+    checks, measurements = validate(rgb, size, photo_landmarks(filename, rgb, size))
+    return {"file": filename,
+            "pass": all(check is not False for check in checks.values()),
+            "checks": checks,
+            "measurements": measurements}
+
+
+def _validate_job(filename):
+    try:
+        return validate_file(filename)
+    except Exception as error:
+        return {"file": filename, "pass": False, "error": str(error)}
+
+
+def photo_files(paths):
+    """
+    Yield the photos of 'paths', directories are searched like in passport_batch.py
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.rsplit(".", 1)[-1].upper() in passport_batch.FILE_FORMATS:
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def validate_files(filenames, processes=PROCESSES):
+    """
+    Yield the results of all photos in the order they are checked
+    """
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        for result in pool.imap_unordered(_validate_job, filenames, CHUNK_SIZE):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "usage: %s photo_or_directory ..." % sys.argv[0]
+        sys.exit(1)
+    count = failed = 0
+    for result in validate_files(photo_files(sys.argv[1:])):
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+        count += 1
+        failed += not result["pass"]
+    sys.stderr.write("%d of %d photos failed\n" % (failed, count))
+    sys.exit(1 if failed else 0)
@@ -14,10 +14,16 @@ scale_factor               = 0.15 # relative to the smaller edge in the picture
 watermark                  = "/home/phil/signature3.png" #"/home/phil/path3700.png"
 watermark_opacity          = 30.0
 watermark_shadow_opacity   = 35.0
+watermark_bucket           = 16   # scaled watermarks are shared by sizes within this many pixels
+watermark_cache_size       = 16   # maximum number of scaled watermarks kept in memory
+watermark_shadow_margin    = 16   # room around the scaled watermark for its drop shadow
+batch_file_formats         = ["JPG", "JPEG", "TIF", "TIFF", "PNG"]
 #########################################################
 
 from gimpfu import *
+from collections import OrderedDict
 import math
+import os
 
 class image(object):
         def __init__(self, runmode, img, drawable):
@@ -32,43 +38,146 @@ class image(object):
         def get_height(self):
                 return height
 
-def insert_watermark(timg, tdrawable):
+class watermark_cache(object):
+        """
+        Loads the watermark once into a hidden image and keeps Lanczos-scaled copies of
+        it for the sizes in use, which are bucketed to watermark_bucket pixels. The drop
+        shadow is rendered once per copy as well, only the finished layers are copied
+        into the images.
+        """
+        def __init__(self, filename):
+                self.filename = filename
+                self.source = None
+                self.variants = OrderedDict()
+
+        def size(self, width, height):
+                # watermark size for an image of width x height (see scale_factor)
+                if self.source is None:
+                        self.source = pdb.gimp_file_load(self.filename, self.filename)
+                if(width < height):
+                        edge = height * scale_factor / self.source.height
+                else:
+                        edge = width * scale_factor / self.source.width
+                reference = max(self.source.width, self.source.height)
+                bucket = max(1, int(round(reference * edge / watermark_bucket))) * watermark_bucket
+                scale = float(bucket) / reference
+                return (max(1, int(round(self.source.width * scale))),
+                        max(1, int(round(self.source.height * scale))))
+
+        def render(self, key):
+                # scaled copy of the watermark with its drop shadow in a hidden image
+                variant = pdb.gimp_image_duplicate(self.source)
+                pdb.gimp_image_undo_disable(variant)
+                layer_watermark = pdb.gimp_image_merge_visible_layers(variant, CLIP_TO_IMAGE)
+                pdb.gimp_image_scale_full(variant, key[0], key[1], INTERPOLATION_LANCZOS)
+                # the shadow is offset and grown beyond the watermark, without room on
+                # every side the canvas of the hidden image would clip it
+                margin = watermark_shadow_margin
+                pdb.gimp_image_resize(variant, key[0] + 2 * margin, key[1] + 2 * margin,
+                                      margin, margin)
+                layer_watermark.name = "watermark"
+                if use_fxfoundry_interface == 1:
+                        pdb.gimp_layer_resize_to_image_size(layer_watermark)
+                        pdb.script_fu_layer_effects_drop_shadow(variant,layer_watermark,gimpcolor.RGB(0, 0, 0, 255),
+                                                                30.0, 6.0, 0.0, 5.0, watermark_shadow_opacity, NORMAL_MODE)
+                else:
+                        pdb.python_layerfx_drop_shadow(variant,layer_watermark,gimpcolor.RGB(0, 0, 0, 255),
+                                                       watermark_shadow_opacity,0,0.0,NORMAL_MODE,0.0,5,120.0,5.0,1,0)
+                # layerfx puts the watermark and its shadow into a layer group
+                layers = []
+                for layer in variant.layers:
+                        if pdb.gimp_item_is_group(layer):
+                                layers.extend(layer.children)
+                        else:
+                                layers.append(layer)
+                layer_shadow = [l for l in layers if l.name != layer_watermark.name][0]
+                return variant, layer_watermark, layer_shadow
+
+        def layers(self, timg, width, height):
+                """
+                Return new layers of 'timg' with the watermark scaled for its size and
+                its drop shadow
+                """
+                key = self.size(width, height)
+                if key in self.variants:
+                        variant = self.variants.pop(key)
+                else:
+                        variant = self.render(key)
+                        while len(self.variants) >= watermark_cache_size:
+                                pdb.gimp_image_delete(self.variants.popitem(False)[1][0])
+                self.variants[key] = variant # most recently used last
+                copies = []
+                for layer in variant[1:]:
+                        # the watermark is at (margin, margin) in the hidden image and at
+                        # the origin of 'timg'
+                        copy = pdb.gimp_layer_new_from_drawable(layer, timg)
+                        copy.set_offsets(layer.offsets[0] - watermark_shadow_margin,
+                                         layer.offsets[1] - watermark_shadow_margin)
+                        copies.append(copy)
+                return copies
+
+        def clear(self):
+                # the hidden images live in the gimp core until they are deleted
+                for variant in self.variants.values():
+                        pdb.gimp_image_delete(variant[0])
+                self.variants.clear()
+                if self.source is not None:
+                        pdb.gimp_image_delete(self.source)
+                        self.source = None
+
+def insert_watermark(timg, tdrawable, cache=None):
     width = tdrawable.width
     height = tdrawable.height
+    single = cache is None
+    if single:
+        cache = watermark_cache(watermark)
 
     pdb.gimp_image_undo_group_start(timg)
 
-    layer_watermark = pdb.gimp_file_load_layer(timg, watermark)
+    layer_watermark, layer_watermark_dropshadow = cache.layers(timg, width, height)
     layer_watermark.name = "watermark"
     layer_watermark.mode = GRAIN_EXTRACT_MODE
     layer_watermark.opacity = watermark_opacity
+    layer_watermark_dropshadow.mode = NORMAL_MODE
+    layer_watermark_dropshadow.opacity = watermark_shadow_opacity
+    pdb.gimp_image_add_layer(timg, layer_watermark_dropshadow, 0)
     pdb.gimp_image_add_layer(timg, layer_watermark, 0)
     image_aspect = float(width) / float(height)
     watermark_aspect = float(layer_watermark.width) / float(layer_watermark.height)
-    if(width < height):
-        new_height = height * scale_factor
-        scale      = new_height / layer_watermark.height 
-        new_width  = layer_watermark.width * scale
-    else:
-        new_width  = width * scale_factor
-        scale      = new_width / layer_watermark.width
-        new_height = layer_watermark.height * scale
     print "image width: %u / height: %u / aspect: %f" % (width, height, image_aspect)
-    print "watermark: width: %u  / height: %u  / aspect: %f" % (new_width, new_height, watermark_aspect)
-    pdb.gimp_layer_scale_full(layer_watermark, new_width, new_height, 1, INTERPOLATION_LANCZOS)
+    print "watermark: width: %u  / height: %u  / aspect: %f" % (layer_watermark.width, layer_watermark.height, watermark_aspect)
     timg.active_layer = layer_watermark
-    if use_fxfoundry_interface == 1:
-        pdb.gimp_layer_resize_to_image_size(layer_watermark)
-        pdb.script_fu_layer_effects_drop_shadow(timg,layer_watermark,gimpcolor.RGB(0, 0, 0, 255),
-                                                30.0, 6.0, 0.0, 5.0, watermark_shadow_opacity, NORMAL_MODE)
-    else:                                   
-        pdb.python_layerfx_drop_shadow(timg,layer_watermark,gimpcolor.RGB(0, 0, 0, 255),
-                                       watermark_shadow_opacity,0,0.0,NORMAL_MODE,0.0,5,120.0,5.0,1,0)
-                                    
-    layer_watermark_dropshadow = timg.layers[1]
     pdb.gimp_item_set_linked(layer_watermark, 1)
     pdb.gimp_item_set_linked(layer_watermark_dropshadow, 1)
     pdb.gimp_image_undo_group_end(timg)
+    if single:
+        cache.clear()
+
+def insert_watermark_batch(directory, output_directory):
+    """
+    Watermark all images in 'directory' and save them under the same name to
+    'output_directory', the watermark is loaded and scaled only once per size bucket
+    """
+    cache = watermark_cache(watermark)
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    try:
+        for name in sorted(os.listdir(directory)):
+            if name.rsplit(".", 1)[-1].upper() not in batch_file_formats:
+                continue
+            filename = os.path.join(directory, name)
+            print "watermarking %s" % filename
+            img = pdb.gimp_file_load(filename, filename)
+            pdb.gimp_image_undo_disable(img)
+            try:
+                insert_watermark(img, img.layers[0], cache)
+                drawable = pdb.gimp_image_flatten(img)
+                output = os.path.join(output_directory, name)
+                pdb.gimp_file_save(img, drawable, output, output)
+            finally:
+                pdb.gimp_image_delete(img)
+    finally:
+        cache.clear()
 
 
 register(
@@ -84,4 +193,20 @@ register(
         [],
         insert_watermark)
 
+register(
+        "python_fu_insert_watermark_batch",
+        "Insert Watermark into all images of a directory",
+        "Insert Watermark into all images of a directory",
+        "Philipp Lutz",
+        "Philipp Lutz",
+        "2010-2011",
+        "<Toolbox>/Xtns/Misc/Insert Watermark (Batch)...",
+        "",
+        [
+                (PF_DIRNAME, "directory", "Input directory", os.getcwd()),
+                (PF_DIRNAME, "output_directory", "Output directory", os.getcwd()),
+        ],
+        [],
+        insert_watermark_batch)
+
 main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#########################################################################################
+# watermark_batch.py
+#
+# Description:
+# ------------
+# Watermarks whole directory trees without gimp (see watermark_compositor.py) as
+# described by a recipe file:
+#
+#    python watermark_batch.py recipe.json
+#
+# Documentation:
+# --------------
+#
+# recipe (JSON):
+# {
+#    "input":          STRING,     # directory which is watermarked recursively
+#    "output":         STRING,     # the same tree is created below this directory
+#    "watermark":      STRING,     # RGBA image, e.g. a PNG
+#    "scale":          FLOAT,      # watermark size relative to "scale_edge" of the image
+#    "scale_edge":     STRING,     # long, short, width or height
+#    "min_size":       INT,        # limits of the longer watermark edge in pixels,
+#    "max_size":       INT,        # 0 means no limit
+#    "anchor":         STRING,     # top-left, top, top-right, left, center, right,
+#                                  # bottom-left, bottom or bottom-right
+#    "margin":         FLOAT,      # distance to the border relative to the shorter edge
+#    "opacity":        FLOAT,
+#    "shadow_opacity": FLOAT,
+#    "quality":        INT,        # JPEG quality
+#    "subsampling":    INT,        # JPEG chroma subsampling, 0 = 4:4:4, 2 = 4:2:0
+#    "output_size":    INT,        # downsize the outputs to this longer edge, 0 keeps
+#                                  # the size (JPEGs are decoded at reduced size)
+#    "directories": {              # overrides of any of the keys above (except input
+#        STRING: {...},            # and output) for a subdirectory of "input" and
+#        ...                       # everything below it, e.g. "clients/acme"
+#    }
+# }
+#
+# Only input, output and watermark are required, the other keys default to the values
+# of watermark.py (see DEFAULT_RECIPE). The recipe is read once, the watermark of every
+# brand is loaded once and its sprites are shared by all images of the batch.
+#
+# The images stream through three stages which overlap:
+#
+#    READER_THREADS        decode the images (PIL releases the GIL while decoding)
+#    COMPOSITOR_PROCESSES  blend the sprites, only the part of the image below the
+#                          watermark and its shadow is sent to the processes
+#    WRITER_THREADS        paste the blended parts back and encode the images (PIL
+#                          releases the GIL while encoding as well)
+#
+# Decoding and encoding are the expensive stages, so by default every stage gets one
+# thread or process per CPU core.
+#
+# At most MAX_IMAGES_IN_FLIGHT decoded images exist at any time, readers wait for the
+# writers when the limit is reached, so the memory use does not depend on the size of
+# the batch.
+#
+#########################################################################################
+
+import watermark_compositor as compositor
+import threading
+import Queue
+import multiprocessing
+import json
+import os
+import sys
+
+FILE_FORMATS = ["JPG", "JPEG", "TIF", "TIFF", "PNG"]
+
+READER_THREADS       = 0        # 0 means one per CPU core
+WRITER_THREADS       = 0        # 0 means one per CPU core
+COMPOSITOR_PROCESSES = 0        # 0 means one per CPU core
+MAX_IMAGES_IN_FLIGHT = 0        # decoded images which wait for compositing or encoding,
+                                # 0 means one per reader and writer thread
+
+DEFAULT_RECIPE = {"scale":          compositor.SCALE_FACTOR,
+                  "scale_edge":     compositor.SCALE_EDGE,
+                  "min_size":       0,
+                  "max_size":       0,
+                  "anchor":         compositor.ANCHOR,
+                  "margin":         0.0,
+                  "opacity":        compositor.OPACITY,
+                  "shadow_opacity": compositor.SHADOW_OPACITY,
+                  "quality":        compositor.JPEG_QUALITY,
+                  "subsampling":    compositor.JPEG_SUBSAMPLING,
+                  "output_size":    0}
+
+# keys which can be overridden per directory
+SETTINGS = ["watermark"] + sorted(DEFAULT_RECIPE)
+
+
+def _check_settings(settings, where):
+    for key, value in settings.items():
+        if key not in SETTINGS:
+            raise ValueError("%s: unknown key %r" % (where, key))
+    if "anchor" in settings and settings["anchor"] not in compositor.ANCHORS:
+        raise ValueError("%s: unknown anchor %r" % (where, settings["anchor"]))
+    if settings.get("scale_edge", "long") not in ("long", "short", "width", "height"):
+        raise ValueError("%s: unknown scale edge %r" % (where, settings["scale_edge"]))
+
+
+def load_recipe(filename):
+    """
+    Read and check a recipe file, returns the recipe with the defaults filled in
+    """
+    with open(filename) as f:
+        recipe = json.load(f)
+    for key in ("input", "output", "watermark"):
+        if key not in recipe:
+            raise ValueError("%s: %r is missing" % (filename, key))
+    directories = {}
+    for directory, settings in recipe.pop("directories", {}).items():
+        _check_settings(settings, "%s: %s" % (filename, directory))
+        directories[os.path.normpath(directory).strip(os.sep)] = settings
+    paths = dict((key, recipe.pop(key)) for key in ("input", "output"))
+    _check_settings(recipe, filename)
+    settings = dict(DEFAULT_RECIPE)
+    settings.update(recipe)
+    settings.update(paths)
+    settings["directories"] = directories
+    return settings
+
+
+def directory_settings(recipe, directory):
+    """
+    Return the settings for 'directory' (relative to the input directory), the
+    overrides of the parent directories apply from the top down
+    """
+    settings = dict((key, recipe[key]) for key in SETTINGS)
+    for override in sorted(recipe["directories"], key=lambda d: d.count(os.sep)):
+        if directory == override or directory.startswith(override + os.sep):
+            settings.update(recipe["directories"][override])
+    return settings
+
+
+def batch_jobs(recipe):
+    """
+    Yield (input file, output file, settings) for all images below the input directory
+    """
+    for root, dirs, files in os.walk(recipe["input"]):
+        dirs.sort()
+        directory = os.path.relpath(root, recipe["input"])
+        directory = "" if directory == os.curdir else directory
+        settings = directory_settings(recipe, directory)
+        for name in sorted(files):
+            if name.rsplit(".", 1)[-1].upper() in FILE_FORMATS:
+                yield (os.path.join(root, name),
+                       os.path.join(recipe["output"], directory, name), settings)
+
+
+class BrandCache(object):
+    """
+    SpriteCaches of all watermark settings in use, every watermark file is loaded once
+    """
+    def __init__(self):
+        self.watermarks = {}
+        self.caches = {}
+        self.lock = threading.Lock()
+
+    def get(self, settings):
+        key = tuple(settings[k] for k in ("watermark", "scale", "scale_edge", "min_size",
+                                          "max_size", "opacity", "shadow_opacity"))
+        with self.lock:
+            return self.caches.get(key) or self.add(key, settings)
+
+    def add(self, key, settings):
+        if key not in self.caches:
+            filename = settings["watermark"]
+            if filename not in self.watermarks:
+                self.watermarks[filename] = compositor.load_watermark(filename)
+            self.caches[key] = compositor.SpriteCache(self.watermarks[filename],
+                                                      settings["scale"],
+                                                      settings["opacity"],
+                                                      settings["shadow_opacity"],
+                                                      settings["scale_edge"],
+                                                      settings["min_size"],
+                                                      settings["max_size"])
+        return self.caches[key]
+
+
+def make_directory(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass # created by another writer
+
+
+# sprites of the compositor processes
+_brands = None
+
+
+def _init_compositor():
+    global _brands
+    _brands = BrandCache()
+
+
+def _composite(part, position, width, height, settings):
+    """
+    Blend the sprite for an image of width x height onto 'part' of it, runs in the
+    compositor processes
+    """
+    return compositor.blend_sprite(part, _brands.get(settings).get(width, height), position)
+
+
+class WatermarkPipeline(object):
+    """
+    Runs the watermark jobs through reader threads, a compositor process pool and
+    writer threads, see the description at the top
+    """
+    def __init__(self, readers=READER_THREADS, writers=WRITER_THREADS,
+                 processes=COMPOSITOR_PROCESSES, in_flight=MAX_IMAGES_IN_FLIGHT):
+        self.readers = readers or multiprocessing.cpu_count()
+        self.writers = writers or multiprocessing.cpu_count()
+        self.processes = processes or multiprocessing.cpu_count()
+        self.jobs = Queue.Queue(self.readers)
+        self.decoded = Queue.Queue()
+        self.in_flight = threading.BoundedSemaphore(in_flight or self.readers + self.writers)
+        self.brands = BrandCache()      # the readers only need the watermark sizes
+        self.lock = threading.Lock()
+        self.count = 0
+        self.failed = []
+
+    def fail(self, filename, error):
+        print "failed to watermark %s: %s" % (filename, error)
+        with self.lock:
+            self.failed.append(filename)
+
+    def read(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            filename, output, settings = job
+            self.in_flight.acquire()
+            try:
+                data, exif = compositor.load_image(filename, settings["output_size"])
+                height, width = data.shape[:2]
+                size = self.brands.get(settings).size(width, height)
+                x, y = compositor.watermark_position(width, height, size, settings["anchor"],
+                                                     settings["margin"])
+                # the part of the image the watermark and its shadow can reach
+                margin = compositor.shadow_margin()
+                box = (max(0, x - margin), max(0, y - margin),
+                       min(width, x + size[0] + margin), min(height, y + size[1] + margin))
+                part = data[box[1]:box[3], box[0]:box[2]]
+                result = self.pool.apply_async(_composite, (part, (x - box[0], y - box[1]),
+                                                            width, height, settings))
+                self.decoded.put((filename, output, settings, data, exif, box, result))
+            except Exception as error:
+                self.in_flight.release()
+                self.fail(filename, error)
+
+    def write(self):
+        while True:
+            image = self.decoded.get()
+            if image is None:
+                return
+            filename, output, settings, data, exif, box, result = image
+            try:
+                data[box[1]:box[3], box[0]:box[2]] = result.get()
+                make_directory(os.path.dirname(output))
+                compositor.save_image(data, output, settings["quality"],
+                                      settings["subsampling"], exif)
+                print "watermarked %s" % filename
+                with self.lock:
+                    self.count += 1
+            except Exception as error:
+                self.fail(filename, error)
+            finally:
+                del data
+                self.in_flight.release()
+
+    def run(self, jobs):
+        """
+        Watermark all jobs (input file, output file, settings), returns the number of
+        watermarked images
+        """
+        self.pool = multiprocessing.Pool(self.processes, _init_compositor)
+        readers = [threading.Thread(target=self.read) for i in range(self.readers)]
+        writers = [threading.Thread(target=self.write) for i in range(self.writers)]
+        try:
+            for thread in readers + writers:
+                thread.daemon = True
+                thread.start()
+            for job in jobs:
+                self.jobs.put(job)
+        finally:
+            for thread in readers:
+                self.jobs.put(None)
+            for thread in readers:
+                thread.join()
+            for thread in writers:
+                self.decoded.put(None)
+            for thread in writers:
+                thread.join()
+            self.pool.close()
+            self.pool.join()
+        return self.count
+
+
+def run_recipe(recipe):
+    """
+    Watermark all images of a recipe, returns the number of images
+    """
+    pipeline = WatermarkPipeline()
+    count = pipeline.run(batch_jobs(recipe))
+    if pipeline.failed:
+        print "%d images failed" % len(pipeline.failed)
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "usage: %s recipe.json" % sys.argv[0]
+        sys.exit(1)
+    print "%d images watermarked" % run_recipe(load_recipe(sys.argv[1]))
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#########################################################################################
+# watermark_compositor.py
+#
+# Description:
+# ------------
+# Inserts the watermark like watermark.py does, but with NumPy and PIL instead of a
+# running gimp, so it can be called from any Python process.
+#
+# Documentation:
+# --------------
+#
+# The result matches the layers watermark.py creates in gimp:
+#
+#    image
+#    drop shadow   NORMAL_MODE at SHADOW_OPACITY, rendered like python_layerfx_drop_shadow
+#                  (blur shape of SHADOW_SIZE, cast in SHADOW_ANGLE by SHADOW_DISTANCE
+#                  pixels, knocked out below the watermark)
+#    watermark     GRAIN_EXTRACT_MODE at OPACITY: image - watermark + 128
+#
+# The watermark is scaled to SCALE_FACTOR of the image edge like in watermark.py and
+# placed at the top left corner (the offset of a new gimp layer) unless a position is
+# given, see watermark_size() and watermark_position() for the other scale rules and
+# anchors. Images are float32 arrays with values in the range [0, 1].
+#
+# The shadow only depends on the watermark and its size, so for batches both layers are
+# rendered once per size into a sprite (see render_sprite() and SpriteCache) which is
+# blended onto the images in a single pass:
+#
+#    image = image * keep + shade                       (drop shadow)
+#    image = image + (clip(image + grain) - image) * alpha    (grain extract)
+#
+# Watermark sizes are bucketed to SPRITE_BUCKET pixels of the longer edge, so similar
+# image sizes share a sprite.
+#
+# Images can be downsized while they are watermarked (see load_image()): JPEGs are then
+# decoded at 1/2, 1/4 or 1/8 of their size in the DCT domain (PIL's draft mode) and only
+# resized for the rest, the watermark is placed at the output resolution.
+#
+#########################################################################################
+
+from PIL import Image
+from collections import OrderedDict, namedtuple
+import math
+import numpy as np
+
+# same defaults as watermark.py and its python_layerfx_drop_shadow call
+SCALE_FACTOR     = 0.15         # relative to the smaller edge in the picture
+OPACITY          = 30.0
+SHADOW_OPACITY   = 35.0
+SHADOW_COLOR     = (0.0, 0.0, 0.0)
+SHADOW_SIZE      = 5            # size of the shadow's blur
+SHADOW_ANGLE     = 120.0        # angle the shadow is cast in
+SHADOW_DISTANCE  = 5.0          # distance between the watermark and its shadow
+SHADOW_KNOCKOUT  = 1            # remove the shadow below the watermark
+JPEG_QUALITY     = 95
+JPEG_SUBSAMPLING = 2            # chroma subsampling of JPEGs: 0 = 4:4:4, 1 = 4:2:2, 2 = 4:2:0
+SCALE_EDGE       = "long"       # image edge SCALE_FACTOR refers to: long, short, width, height
+ANCHOR           = "top-left"   # e.g. top-left, top, center, bottom-right (see ANCHORS)
+SPRITE_BUCKET    = 16           # sprites are shared by watermark sizes within this many pixels
+SPRITE_CACHE_SIZE = 16          # maximum number of sprites kept per SpriteCache
+
+_GRAIN_OFFSET = 128 / 255.0
+
+# relative position (x, y) of the watermark in the free space of the image
+ANCHORS = {"top-left":    (0.0, 0.0), "top":    (0.5, 0.0), "top-right":    (1.0, 0.0),
+           "left":        (0.0, 0.5), "center": (0.5, 0.5), "right":        (1.0, 0.5),
+           "bottom-left": (0.0, 1.0), "bottom": (0.5, 1.0), "bottom-right": (1.0, 1.0)}
+
+
+def load_watermark(filename):
+    """
+    Load the watermark as float32 RGBA array with values in the range [0, 1]
+    """
+    return np.asarray(Image.open(filename).convert("RGBA"), dtype=np.float32) / 255.0
+
+
+def watermark_size(watermark, width, height, scale_factor=SCALE_FACTOR, edge=SCALE_EDGE,
+                   min_size=0, max_size=0):
+    """
+    Return (width, height) of the watermark for an image of width x height. The
+    watermark edge parallel to the image 'edge' gets scale_factor of its length
+    ("long" is what watermark.py does), the longer watermark edge is then clamped to
+    min_size / max_size pixels unless they are 0.
+    """
+    wm_height, wm_width = watermark.shape[:2]
+    if edge == "long":
+        edge = "height" if width < height else "width"
+    elif edge == "short":
+        edge = "width" if width < height else "height"
+    if edge == "height":
+        scale = height * scale_factor / wm_height
+    elif edge == "width":
+        scale = width * scale_factor / wm_width
+    else:
+        raise ValueError("unknown scale edge %r" % edge)
+    longest = max(wm_width, wm_height) * scale
+    if min_size and longest < min_size:
+        scale *= float(min_size) / longest
+    elif max_size and longest > max_size:
+        scale *= float(max_size) / longest
+    return max(1, int(round(wm_width * scale))), max(1, int(round(wm_height * scale)))
+
+
+def watermark_position(width, height, size, anchor=ANCHOR, margin=0.0):
+    """
+    Return the top left corner (x, y) of a watermark of 'size' (width, height) in an
+    image of width x height. 'margin' is the distance to the image border relative
+    to the shorter image edge.
+    """
+    ax, ay = ANCHORS[anchor]
+    border = int(round(min(width, height) * margin))
+    return (border + int(round((width - size[0] - 2 * border) * ax)),
+            border + int(round((height - size[1] - 2 * border) * ay)))
+
+
+def scale_watermark(watermark, size):
+    """
+    Lanczos-scale an RGBA watermark to size (width, height)
+    """
+    data = np.clip(watermark * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    scaled = Image.fromarray(data, "RGBA").resize(size, Image.LANCZOS)
+    return np.asarray(scaled, dtype=np.float32) / 255.0
+
+
+def _grow(mask, radius):
+    """
+    Grow (radius > 0) or shrink (radius < 0) a grayscale selection by a disc
+    """
+    if radius == 0:
+        return mask
+    if radius < 0:
+        return 1.0 - _grow(1.0 - mask, -radius)
+    height, width = mask.shape
+    padded = np.pad(mask, radius, "constant")
+    grown = mask.copy()
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if dx * dx + dy * dy <= radius * radius:
+                np.maximum(grown, padded[radius + dy:radius + dy + height,
+                                         radius + dx:radius + dx + width], out=grown)
+    return grown
+
+
+def _round(value):
+    # python 2 rounding (half away from zero), as used by layerfx
+    return int(math.floor(abs(value) + 0.5)) * (1 if value >= 0 else -1)
+
+
+def drop_shadow(alpha, size=SHADOW_SIZE, angle=SHADOW_ANGLE, distance=SHADOW_DISTANCE,
+                knockout=SHADOW_KNOCKOUT):
+    """
+    Render the drop shadow mask of a layer with the alpha channel 'alpha'. Returns the
+    mask, which is larger than the layer, and its offset (x, y) relative to the layer.
+    """
+    grow = int(math.ceil(size / 2.0))
+    border = int(round(grow * 1.2))
+    angle = -(angle + 180) * math.pi / 180.0
+    offset = (_round(distance * math.cos(angle)), _round(distance * math.sin(angle)))
+    height, width = alpha.shape
+    selection = np.zeros((height + 2 * border, width + 2 * border), dtype=np.float32)
+    selection[border:border + height, border:border + width] = alpha
+    # the blur shape: the selection grown by decreasing amounts filled with increasing shades
+    mask = np.zeros_like(selection)
+    for i in range(size):
+        grown = _grow(selection, grow - i)
+        mask += (float(i + 1) / size - mask) * grown
+    if knockout:
+        x, y = border - offset[0], border - offset[1]
+        region = mask[max(0, y):y + height, max(0, x):x + width]
+        region *= 1.0 - alpha[max(0, -y):max(0, -y) + region.shape[0],
+                              max(0, -x):max(0, -x) + region.shape[1]]
+    return mask, (offset[0] - border, offset[1] - border)
+
+
+def shadow_margin(size=SHADOW_SIZE, distance=SHADOW_DISTANCE):
+    """
+    Return how many pixels the drop shadow can reach beyond the watermark
+    """
+    return int(round(math.ceil(size / 2.0) * 1.2)) + int(math.ceil(distance))
+
+
+def _region(image, layer, x, y):
+    """
+    Return the overlapping parts of 'image' and of 'layer' placed at (x, y)
+    """
+    height, width = image.shape[:2]
+    top, left = max(0, y), max(0, x)
+    bottom = min(height, y + layer.shape[0])
+    right = min(width, x + layer.shape[1])
+    if bottom <= top or right <= left:
+        return None, None
+    return (image[top:bottom, left:right],
+            layer[top - y:bottom - y, left - x:right - x])
+
+
+def blend_normal(image, color, alpha, x, y):
+    """
+    Paint 'color' through the mask 'alpha' placed at (x, y) onto 'image' (in place)
+    """
+    target, alpha = _region(image, alpha, x, y)
+    if target is not None:
+        target += (np.asarray(color, dtype=np.float32) - target) * alpha[:, :, np.newaxis]
+
+
+def blend_grain_extract(image, layer, opacity, x, y):
+    """
+    Blend the RGBA 'layer' placed at (x, y) in grain extract mode onto 'image' (in place)
+    """
+    target, layer = _region(image, layer, x, y)
+    if target is not None:
+        alpha = layer[:, :, 3:] * (opacity / 100.0)
+        extract = np.clip(target - layer[:, :, :3] + _GRAIN_OFFSET, 0.0, 1.0)
+        target += (extract - target) * alpha
+
+
+def insert_watermark(image, watermark, position=(0, 0), opacity=OPACITY,
+                     shadow_opacity=SHADOW_OPACITY):
+    """
+    Insert the already scaled RGBA 'watermark' with its drop shadow into the RGB
+    'image' (in place), 'position' is the top left corner of the watermark
+    """
+    x, y = position
+    mask, (dx, dy) = drop_shadow(watermark[:, :, 3])
+    blend_normal(image, SHADOW_COLOR, mask * (shadow_opacity / 100.0), x + dx, y + dy)
+    blend_grain_extract(image, watermark, opacity, x, y)
+    return image
+
+
+# a watermark with its drop shadow, prepared for blending in one pass, 'offset' is the
+# position of the sprite relative to the top left corner of the watermark and 'size'
+# the size (width, height) of the watermark
+Sprite = namedtuple("Sprite", "keep shade grain alpha offset size")
+
+
+def render_sprite(watermark, opacity=OPACITY, shadow_opacity=SHADOW_OPACITY):
+    """
+    Render the already scaled RGBA 'watermark' and its drop shadow into a Sprite
+    """
+    height, width = watermark.shape[:2]
+    mask, (dx, dy) = drop_shadow(watermark[:, :, 3])
+    left, top = min(0, dx), min(0, dy)
+    right = max(width, dx + mask.shape[1])
+    bottom = max(height, dy + mask.shape[0])
+    shadow = np.zeros((bottom - top, right - left, 1), dtype=np.float32)
+    shadow[dy - top:dy - top + mask.shape[0], dx - left:dx - left + mask.shape[1], 0] = \
+        mask * (shadow_opacity / 100.0)
+    grain = np.zeros((bottom - top, right - left, 3), dtype=np.float32)
+    alpha = np.zeros((bottom - top, right - left, 1), dtype=np.float32)
+    grain[-top:height - top, -left:width - left] = _GRAIN_OFFSET - watermark[:, :, :3]
+    alpha[-top:height - top, -left:width - left] = watermark[:, :, 3:] * (opacity / 100.0)
+    return Sprite(1.0 - shadow, shadow * np.asarray(SHADOW_COLOR, dtype=np.float32),
+                  grain, alpha, (left, top), (width, height))
+
+
+def blend_sprite(image, sprite, position=(0, 0)):
+    """
+    Blend a Sprite onto the RGB 'image' (in place) in a single pass, 'position' is the
+    top left corner of the watermark. uint8 images are converted only below the sprite.
+    """
+    x, y = position[0] + sprite.offset[0], position[1] + sprite.offset[1]
+    target, keep = _region(image, sprite.keep, x, y)
+    if target is None:
+        return image
+    rows = slice(max(0, -y), max(0, -y) + keep.shape[0])
+    cols = slice(max(0, -x), max(0, -x) + keep.shape[1])
+    blended = target.astype(np.float32)
+    if image.dtype == np.uint8:
+        blended /= 255.0
+    blended *= keep
+    blended += sprite.shade[rows, cols]
+    blended += (np.clip(blended + sprite.grain[rows, cols], 0.0, 1.0) - blended) * \
+        sprite.alpha[rows, cols]
+    if image.dtype == np.uint8:
+        blended = np.clip(blended * 255.0 + 0.5, 0, 255)
+    target[...] = blended
+    return image
+
+
+class SpriteCache(object):
+    """
+    Sprites of one watermark for the image sizes in use, the least recently used
+    sprites are dropped beyond SPRITE_CACHE_SIZE. Every process keeps its own cache.
+    """
+    def __init__(self, watermark, scale_factor=SCALE_FACTOR, opacity=OPACITY,
+                 shadow_opacity=SHADOW_OPACITY, edge=SCALE_EDGE, min_size=0, max_size=0):
+        if not isinstance(watermark, np.ndarray):
+            watermark = load_watermark(watermark)
+        self.watermark = watermark
+        self.scale_factor = scale_factor
+        self.edge = edge
+        self.min_size = min_size
+        self.max_size = max_size
+        self.opacity = opacity
+        self.shadow_opacity = shadow_opacity
+        self.sprites = OrderedDict()
+
+    def size(self, width, height):
+        """
+        Return the bucketed watermark size for an image of width x height
+        """
+        wm_width, wm_height = watermark_size(self.watermark, width, height, self.scale_factor,
+                                             self.edge, self.min_size, self.max_size)
+        reference = max(self.watermark.shape[:2])
+        edge = max(wm_width, wm_height)
+        scale = float(max(1, int(round(float(edge) / SPRITE_BUCKET))) * SPRITE_BUCKET) / reference
+        return (max(1, int(round(self.watermark.shape[1] * scale))),
+                max(1, int(round(self.watermark.shape[0] * scale))))
+
+    def get(self, width, height):
+        """
+        Return the Sprite for an image of width x height
+        """
+        key = self.size(width, height)
+        sprite = self.sprites.pop(key, None)
+        if sprite is None:
+            sprite = render_sprite(scale_watermark(self.watermark, key),
+                                   self.opacity, self.shadow_opacity)
+            while len(self.sprites) >= SPRITE_CACHE_SIZE:
+                self.sprites.popitem(False)
+        self.sprites[key] = sprite # most recently used last
+        return sprite
+
+
+def output_size(width, height, max_size=0):
+    """
+    Return the size of an image of width x height downsized to 'max_size' pixels on its
+    longer edge, images are never enlarged and 0 keeps the size
+    """
+    if not max_size or max(width, height) <= max_size:
+        return width, height
+    scale = float(max_size) / max(width, height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def load_image(filename, max_size=0):
+    """
+    Load an image as RGB uint8 array downsized to 'max_size' pixels on its longer edge
+    (0 keeps the size), returns the array and the EXIF data
+    """
+    im = Image.open(filename)
+    exif = im.info.get("exif")
+    size = output_size(im.size[0], im.size[1], max_size)
+    if size != im.size:
+        # JPEGs are decoded at the smallest DCT scale which is still >= size
+        im.draft("RGB", size)
+        im = im.convert("RGB")
+        if im.size != size:
+            im = im.resize(size, Image.LANCZOS)
+    return np.array(im.convert("RGB")), exif
+
+
+def save_image(data, output, quality=JPEG_QUALITY, subsampling=JPEG_SUBSAMPLING, exif=None):
+    """
+    Save an RGB uint8 array, JPEGs with the given quality, chroma subsampling and EXIF data
+    """
+    options = {}
+    if output.upper().endswith(("JPG", "JPEG")):
+        options = {"quality": quality, "subsampling": subsampling}
+        if exif:
+            options["exif"] = exif
+    Image.fromarray(data, "RGB").save(output, **options)
+
+
+def watermark_file(filename, output, sprites, quality=JPEG_QUALITY, anchor=ANCHOR,
+                   margin=0.0, subsampling=JPEG_SUBSAMPLING, max_size=0):
+    """
+    Watermark the image file 'filename' and save it to 'output', 'sprites' is the
+    SpriteCache of the watermark. The EXIF data is kept. With 'max_size' the image is
+    downsized to this many pixels on its longer edge first (see load_image()).
+    """
+    data, exif = load_image(filename, max_size)
+    height, width = data.shape[:2]
+    sprite = sprites.get(width, height)
+    blend_sprite(data, sprite, watermark_position(width, height, sprite.size, anchor, margin))
+    save_image(data, output, quality, subsampling, exif)